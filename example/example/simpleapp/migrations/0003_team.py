@@ -0,0 +1,34 @@
+# Generated by Django 4.2.30 on 2026-10-17 03:19
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('simpleapp', '0002_employee'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Membership',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('employee', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='simpleapp.employee')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Team',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('number', models.IntegerField(unique=True)),
+                ('members', models.ManyToManyField(through='simpleapp.Membership', to='simpleapp.employee')),
+            ],
+        ),
+        migrations.AddField(
+            model_name='membership',
+            name='team',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='simpleapp.team', to_field='number'),
+        ),
+    ]
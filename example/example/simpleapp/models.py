@@ -92,3 +92,27 @@ class Actor(models.Model):
 
     def __str__(self):
         return self.name
+
+
+class Employee(models.Model):
+    name = models.CharField(max_length=20)
+    mentor = models.ForeignKey('self', null=True, blank=True, on_delete=models.SET_NULL)
+
+    class Meta:
+        ordering = ('name', )
+
+    def __str__(self):
+        return self.name
+
+
+class Team(models.Model):
+    number = models.IntegerField(unique=True)
+    members = models.ManyToManyField(Employee, through='Membership')
+
+    def __str__(self):
+        return "Team %s" % self.number
+
+
+class Membership(models.Model):
+    team = models.ForeignKey(Team, to_field='number', on_delete=models.CASCADE)
+    employee = models.ForeignKey(Employee, on_delete=models.CASCADE)
@@ -1,14 +1,38 @@
+import bz2
 import datetime
+import gzip
+import hashlib
 import json
+import lzma
+import os
+import tempfile
 from io import StringIO
+from itertools import groupby
+from unittest import mock
 
+from django.apps import apps
 from django.contrib.contenttypes.models import ContentType
+from django.core import serializers
 from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
 from objectdump import settings
+from objectdump.bulk import bulk_load_many2many
+from objectdump.delta import DeltaFilter
+from objectdump.fastjson import get_fast_serializer
+from objectdump.graph import DEPENDS, GENERATES, LABELLED, ObjectGraph
+from objectdump.identity import IdentityMap
+from objectdump.jsonl import Deserializer
+from objectdump.management.commands.object_dump import Command
+from objectdump.models import ObjectFilter, ObjectKey
+from objectdump.plan import compile_plan
+from objectdump.serializer import get_serializer
+from objectdump.topological_sort import CyclicDependencyError, toposort
 
-from .models import (Article, Author, AuthorProfile, Category, Tag,
-                     TaggedArticle, TaggedItem)
+from .models import (Article, Author, AuthorProfile, Category, Employee, Membership, Tag,
+                     TaggedArticle, TaggedItem, Team)
 
 
 def get_tagged_items(obj):
@@ -137,3 +161,759 @@ class CustomObjectDumpTestCase(CommonObjectDumpTestCase):
     #     '[<Author: Obi Wan>,\n <AuthorProfile: Profile of Obi Wan>,\n <Category: World>,\n <Tag: Star>,\n <Tag: War>,\n <TaggedArticle: Stars at war>,\n <TaggedItem: Tag: Star, Model: Stars at war>,\n <TaggedItem: Tag: War, Model: Stars at war>]\n'
 
     #     self.assertEquals(ar1_output, output.getvalue())
+
+
+class TaggedDumpMixin(object):
+    """
+    Follow the tagged items of the articles, for the ``CommonObjectDumpTestCase``
+    tests that call ``object_dump`` with ``dump()``
+    """
+    dump_options = {}
+
+    def setUp(self):
+        super(TaggedDumpMixin, self).setUp()
+        self.addCleanup(setattr, settings, 'MODEL_SETTINGS', settings.MODEL_SETTINGS)
+        settings.MODEL_SETTINGS = {
+            'simpleapp.taggedarticle': {'addl_relations': [get_tagged_items]},
+            'simpleapp.tag': {'reverse_relations': False},
+        }
+
+    def dump(self, *args, **options):
+        output = StringIO()
+        call_command("object_dump", *args, stdout=output, **dict(self.dump_options, **options))
+        return output.getvalue()
+
+
+class BatchObjectDumpTestCase(TaggedDumpMixin, CommonObjectDumpTestCase):
+
+    def test_same_output(self):
+        for args in (("simpleapp.taggedarticle", "1"),
+                     ("simpleapp.author", )):
+            self.assertEqual(self.dump(*args), self.dump(*args, batch=True))
+            self.assertEqual(self.dump(*args, depth=0, limit=1),
+                             self.dump(*args, depth=0, limit=1, batch=True))
+
+    def test_keys_only_same_output(self):
+        for args in (("simpleapp.taggedarticle", "1"),
+                     ("simpleapp.author", ),
+                     ("simpleapp.taggeditem", )):
+            self.assertEqual(self.dump(*args), self.dump(*args, keys_only=True))
+            self.assertEqual(self.dump(*args, depth=0, limit=1),
+                             self.dump(*args, depth=0, limit=1, keys_only=True))
+
+    def test_order_by_model(self):
+        def key(item):
+            return item['model'], item['pk']
+
+        expected = sorted(json.loads(self.dump("simpleapp.author")), key=key)
+        for options in ({}, {'batch': True}, {'keys_only': True}):
+            output = json.loads(self.dump("simpleapp.author", order="model", **options))
+            self.assertEqual(expected, sorted(output, key=key))
+            models = [model for model, items in groupby(item['model'] for item in output)]
+            self.assertEqual(len(models), len(set(models)))
+            self.assertLess(models.index('simpleapp.author'), models.index('simpleapp.taggedarticle'))
+            self.assertLess(models.index('simpleapp.tag'), models.index('simpleapp.taggeditem'))
+            self.assertLess(models.index('contenttypes.contenttype'), models.index('simpleapp.taggeditem'))
+
+    def assertDependenciesFirst(self, output):
+        seen = set()
+        for item in output:
+            model = apps.get_model(item['model'])
+            for field in model._meta.fields + model._meta.many_to_many:
+                if not field.is_relation or item['fields'].get(field.name) is None:
+                    continue
+                values = item['fields'][field.name]
+                for value in values if field.many_to_many else [values]:
+                    self.assertIn((field.related_model._meta.label_lower, value), seen)
+            seen.add((item['model'], item['pk']))
+
+    def test_online_order(self):
+        def key(item):
+            return item['model'], item['pk']
+
+        expected = sorted(json.loads(self.dump("simpleapp.author")), key=key)
+        for options in ({}, {'batch': True}):
+            output = json.loads(self.dump("simpleapp.author", order="online", **options))
+            self.assertEqual(expected, sorted(output, key=key))
+            self.assertDependenciesFirst(output)
+
+    def test_online_order_limit(self):
+        # The limit leaves "World" out of the traversal of the first article,
+        # but its key is serialized, and the last article dumps it.
+        self.ar1.categories.add(Category.objects.create(name="Alpha"))
+        ar4 = TaggedArticle.objects.create(author=self.a3, headline="World news", pub_date=datetime.datetime(2013, 1, 2, 12, 0, 0, 0, UTC))
+        ar4.categories.add(self.c1)
+        for options in ({}, {'batch': True}):
+            output = json.loads(self.dump("simpleapp.taggedarticle", order="online", limit=1, **options))
+            self.assertIn({'model': 'simpleapp.category', 'pk': self.c1.pk, 'fields': {'name': "World"}}, output)
+            self.assertDependenciesFirst(output)
+
+    def test_online_order_emits_while_traversing(self):
+        command = Command()
+        command.verbose = False
+        command.use_obj_key = True
+        objs = command.process_online(Author.objects.all(), ObjectFilter(Author))
+        self.assertIsInstance(next(objs), (Author, ContentType))
+        self.assertTrue(command.queue)
+
+    def test_fewer_queries(self):
+        with CaptureQueriesContext(connection) as queue_queries:
+            self.dump("simpleapp.author")
+        with CaptureQueriesContext(connection) as batch_queries:
+            self.dump("simpleapp.author", batch=True)
+        self.assertLess(len(batch_queries), len(queue_queries))
+
+    def test_foreignkeys_loaded_in_bulk(self):
+        TaggedArticle.objects.create(author=self.a1, headline="Return of the Jedi", pub_date=datetime.datetime(2013, 1, 2, 12, 0, 0, 0, UTC))
+        with CaptureQueriesContext(connection) as queries:
+            self.dump("simpleapp.taggedarticle", batch=True)
+        author_queries = [q for q in queries
+                          if 'FROM "simpleapp_author"' in q['sql']]
+        # One to traverse, one to load the fields of the serialized authors.
+        self.assertEqual(len(author_queries), 2)
+
+    def test_traversal_loads_relation_columns(self):
+        expected = self.dump("simpleapp.taggedarticle")
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(expected, self.dump("simpleapp.taggedarticle", batch=True))
+        author_queries = [q['sql'] for q in queries
+                          if 'FROM "simpleapp_author"' in q['sql']]
+        self.assertEqual(len(author_queries), 2)
+        self.assertNotIn('"simpleapp_author"."name"', author_queries[0])
+        self.assertIn('"simpleapp_author"."name"', author_queries[1])
+
+    def test_limit_per_parent(self):
+        TaggedArticle.objects.create(author=self.a1, headline="Return of the Jedi", pub_date=datetime.datetime(2013, 1, 2, 12, 0, 0, 0, UTC))
+        expected = self.dump("simpleapp.author", limit=1)
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(expected, self.dump("simpleapp.author", limit=1, batch=True))
+        if connection.features.supports_over_clause:
+            self.assertTrue(any('ROW_NUMBER' in q['sql'] for q in queries))
+        with mock.patch('objectdump.bulk.supports_window_prefetch', return_value=False):
+            self.assertEqual(expected, self.dump("simpleapp.author", limit=1, batch=True))
+
+    def test_many2many_through_table_read_once(self):
+        with CaptureQueriesContext(connection) as queries:
+            self.dump("simpleapp.taggedarticle", batch=True)
+        through_queries = [q for q in queries
+                           if 'simpleapp_taggedarticle_categories' in q['sql']]
+        self.assertEqual(len(through_queries), 1)
+
+    def test_genericforeignkeys_grouped_by_content_type(self):
+        expected = self.dump("simpleapp.taggeditem", depth=0)
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(expected, self.dump("simpleapp.taggeditem", depth=0, batch=True))
+        article_queries = [q for q in queries
+                           if 'FROM "simpleapp_taggedarticle"' in q['sql']]
+        self.assertEqual(len(article_queries), 1)
+
+    def test_plan_compiled_once_per_model(self):
+        with mock.patch('objectdump.management.commands.object_dump.compile_plan',
+                        wraps=compile_plan) as compile_mock:
+            self.dump("simpleapp.taggedarticle", batch=True)
+        models = [call[0][0] for call in compile_mock.call_args_list]
+        self.assertEqual(len(models), len(set(models)))
+
+
+class ObjectFilterTestCase(TestCase):
+    def test_decisions_precomputed(self):
+        obj_filter = ObjectFilter(Article, ['simpleapp.author'], [])
+        with mock.patch('objectdump.models.get_app') as get_app:
+            self.assertTrue(obj_filter.skip(Author(name="Luke")))
+            self.assertFalse(obj_filter.skip(Article(headline="Stars at war")))
+            self.assertFalse(obj_filter.skip(Category(name="World")))
+        self.assertFalse(get_app.called)
+
+    def test_include(self):
+        obj_filter = ObjectFilter(Article, [], ['simpleapp.category'])
+        self.assertFalse(obj_filter.skip(Article(headline="Stars at war")))
+        self.assertTrue(obj_filter.skip(Author(name="Luke")))
+
+
+class PruneObjectDumpTestCase(CommonObjectDumpTestCase):
+    def setUp(self):
+        super(PruneObjectDumpTestCase, self).setUp()
+        self.addCleanup(setattr, settings, 'MODEL_SETTINGS', settings.MODEL_SETTINGS)
+        settings.MODEL_SETTINGS = {'simpleapp.authorprofile': {'ignore': True}}
+
+    def test_excluded_relations_not_queried(self):
+        output = StringIO()
+        errors = StringIO()
+        with CaptureQueriesContext(connection) as queries:
+            call_command("object_dump", "simpleapp.author", "1", exclude=['simpleapp.category'],
+                         verbosity=2, stdout=output, stderr=errors)
+        self.assertNotIn('simpleapp.category', output.getvalue())
+        self.assertNotIn('simpleapp.authorprofile', output.getvalue())
+        self.assertIn("Pruned simpleapp.article.categories -> simpleapp.category", errors.getvalue())
+        self.assertIn("Pruned simpleapp.author.authorprofile -> simpleapp.authorprofile", errors.getvalue())
+        for query in queries:
+            self.assertNotIn('"simpleapp_category"."name" FROM', query['sql'])
+            self.assertNotIn('FROM "simpleapp_authorprofile"', query['sql'])
+
+
+class ObjectGraphTestCase(TestCase):
+    def test_objects_interned_once(self):
+        author = ObjectKey(Author, 1)
+        article = ObjectKey(Article, 1)
+        graph = ObjectGraph()
+        graph.add_object(article)
+        graph.add_edge(article, author, 'author', GENERATES | LABELLED | DEPENDS)
+        graph.add_edge(ObjectKey(Author, 1), article, 'article_set')
+        self.assertEqual(len(graph), 2)
+        self.assertEqual(graph.dependencies(), {article: {author}, author: set()})
+        self.assertEqual(graph.generates(repr), {
+            '<Article: 1>': {'<Author: 1>'}, '<Author: 1>': {'<Article: 1>'}})
+        self.assertEqual(graph.relationships(repr), {
+            '<Article: 1>': {'author': {'<Author: 1>'}}})
+
+
+class TopologicalSortTestCase(TestCase):
+    def test_layers_sorted_by_key(self):
+        a2, a10 = ObjectKey(Author, 2), ObjectKey(Author, 10)
+        ar1, ar2 = ObjectKey(Article, 1), ObjectKey(Article, 2)
+        c1 = ObjectKey(Category, 1)
+        data = {ar2: {a2, c1}, ar1: {a10, ar1}, a2: set()}
+        self.assertEqual(list(toposort(data)), [a10, a2, c1, ar1, ar2])
+
+    def test_cycles(self):
+        a1, ar1, ar2 = ObjectKey(Author, 1), ObjectKey(Article, 1), ObjectKey(Article, 2)
+        data = {ar2: {ar1}, ar1: {ar2, a1}}
+        self.assertEqual(list(toposort(data, allow_cycles=True)), [a1, ar1, ar2])
+        with self.assertRaises(CyclicDependencyError) as raised:
+            list(toposort(data))
+        self.assertEqual(raised.exception.components, [[ar1, ar2]])
+
+    def test_cyclic_tail_order(self):
+        a3, a4 = ObjectKey(Author, 3), ObjectKey(Author, 4)
+        ar5, ar6 = ObjectKey(Article, 5), ObjectKey(Article, 6)
+        c1, c2 = ObjectKey(Category, 1), ObjectKey(Category, 2)
+        # The items left in or after cycles come by strongly connected
+        # component, each after the ones it depends on and sorted by key,
+        # whatever the order of ``data``.
+        data = {c1: {a4}, a4: {a3, ar6}, a3: {a4}, ar6: {ar5}, ar5: {ar6}, c2: set()}
+        expected = [c2, ar5, ar6, a3, a4, c1]
+        self.assertEqual(list(toposort(data, allow_cycles=True)), expected)
+        reordered = dict(reversed(list(data.items())))
+        self.assertEqual(list(toposort(reordered, allow_cycles=True)), expected)
+
+
+class CycleObjectDumpTestCase(TestCase):
+    def setUp(self):
+        self.e1 = Employee.objects.create(name="Ann")
+        self.e2 = Employee.objects.create(name="Bob", mentor=self.e1)
+        self.e3 = Employee.objects.create(name="Cid", mentor=self.e1)
+        self.e1.mentor = self.e2
+        self.e1.save()
+
+    def dump(self, *args, **options):
+        output = StringIO()
+        call_command("object_dump", *args, stdout=output, **options)
+        return json.loads(output.getvalue())
+
+    def test_cycles_reported(self):
+        with self.assertRaises(CommandError) as raised:
+            self.dump("simpleapp.employee", "3", nocycles=True)
+        self.assertIn("2 objects: simpleapp.employee.mentor -> simpleapp.employee (2)",
+                      str(raised.exception))
+
+    def test_break_cycles(self):
+        output = self.dump("simpleapp.employee", "3", nocycles=True, breakcycles=True)
+        seen = set()
+        for item in output[:3]:
+            mentor = item['fields']['mentor']
+            self.assertTrue(mentor is None or mentor in seen)
+            seen.add(item['pk'])
+        self.assertEqual(len(output), 4)
+        patch = output[3]
+        deferred = [item for item in output[:3] if item['pk'] == patch['pk']][0]
+        self.assertIsNone(deferred['fields']['mentor'])
+        self.assertEqual(deferred['fields']['name'], patch['fields']['name'])
+        mentor = Employee.objects.get(pk=patch['pk']).mentor_id
+        self.assertEqual(patch['fields']['mentor'], mentor)
+
+    def test_online_order_cycles_last(self):
+        output = self.dump("simpleapp.employee", "3", order="online")
+        self.assertEqual([item['pk'] for item in output], [1, 2, 3])
+
+
+class StreamingSerializerTestCase(CommonObjectDumpTestCase):
+    def test_yaml_written_per_object(self):
+        for objs in (list(Author.objects.all()), list(AuthorProfile.objects.all()), []):
+            serializer = get_serializer('yaml')()
+            output = serializer.serialize(objs, stream=StringIO())
+            self.assertEqual(output, serializers.serialize('yaml', objs))
+            self.assertEqual(serializer.objects, [])
+
+    def test_output_buffered(self):
+        expected = StringIO()
+        call_command("object_dump", "simpleapp.author", stdout=expected)
+        for format in ('json', 'xml', 'yaml'):
+            output = StringIO()
+            with mock.patch.object(settings, 'BUFFER_SIZE', 256), \
+                    mock.patch.object(output, 'write', wraps=output.write) as write:
+                call_command("object_dump", "simpleapp.author", format=format, stdout=output)
+            self.assertGreater(write.call_count, 1)
+            self.assertTrue(all(len(args[0]) < 2 * 256 for args, kwargs in write.call_args_list[:-1]))
+            if format == 'json':
+                self.assertEqual(expected.getvalue(), output.getvalue())
+
+
+class FastJSONSerializerTestCase(CommonObjectDumpTestCase):
+    def serialize(self, objs, format='json', **options):
+        return get_fast_serializer(format).serialize(objs, stream=StringIO(), **options)
+
+    def test_same_output(self):
+        Employee.objects.create(name="Ann", mentor=Employee.objects.create(name="Bob"))
+        TaggedArticle.objects.create(
+            author=self.a1, headline="Ünïcode",
+            pub_date=datetime.datetime(2013, 1, 2, 3, 4, 5, 678901, UTC))
+        for model in (Author, AuthorProfile, TaggedArticle, TaggedItem, Employee):
+            objs = list(model.objects.order_by('pk'))
+            keys = [ObjectKey.for_model(model, obj.pk) for obj in objs]
+            deferred = list(model.objects.order_by('pk').only('pk'))
+            for format, indent in (('json', None), ('json', 2), ('jsonl', None)):
+                expected = serializers.serialize(format, objs, indent=indent)
+                for items in (objs, keys, deferred):
+                    self.assertEqual(
+                        self.serialize(items, format, indent=indent, chunk_size=2), expected)
+                self.assertEqual(self.serialize([], format, indent=indent),
+                                 serializers.serialize(format, [], indent=indent))
+
+    def test_selected_fields(self):
+        objs = list(TaggedArticle.objects.all())
+        expected = serializers.serialize('json', objs, fields=['headline', 'categories'])
+        output = self.serialize(objs, fields={'simpleapp.taggedarticle': ['headline', 'categories']})
+        self.assertEqual(output, expected)
+        output = self.serialize(objs, exclude_fields={'simpleapp.taggedarticle': ['author', 'pub_date']})
+        self.assertEqual(output, expected)
+
+    def test_queries(self):
+        keys = [ObjectKey.for_model(TaggedArticle, pk)
+                for pk in TaggedArticle.objects.values_list('pk', flat=True)]
+        # The rows and the categories of each chunk.
+        with self.assertNumQueries(4):
+            self.serialize(keys, chunk_size=2)
+        objs = list(TaggedArticle.objects.all())
+        categories = TaggedArticle._meta.get_field('categories')
+        with self.assertNumQueries(0):
+            self.serialize(objs, m2m_pks={categories: dict((obj.pk, []) for obj in objs)})
+
+
+class JSONLinesTestCase(CommonObjectDumpTestCase):
+    def test_one_object_per_line(self):
+        output = StringIO()
+        call_command("object_dump", "simpleapp.taggedarticle", "1", format="jsonl", stdout=output)
+        expected = StringIO()
+        call_command("object_dump", "simpleapp.taggedarticle", "1", stdout=expected)
+        lines = output.getvalue().splitlines()
+        self.assertEqual([json.loads(line) for line in lines], json.loads(expected.getvalue()))
+
+        output.seek(0)
+        objs = list(Deserializer(output))
+        self.assertEqual([obj.object for obj in objs][:2], [self.a1, self.c1])
+        self.assertEqual(len(objs), len(lines))
+
+
+class CompressedOutputTestCase(CommonObjectDumpTestCase):
+    def test_output_file(self):
+        expected = StringIO()
+        call_command("object_dump", "simpleapp.taggedarticle", stdout=expected)
+        with tempfile.TemporaryDirectory() as directory:
+            for name, options, open_file in (
+                    ("dump.json", {}, open),
+                    ("dump.json.gz", {}, gzip.open),
+                    ("dump.json.bz2", {'compresslevel': 1}, bz2.open),
+                    ("dump.json.xz", {}, lzma.open),
+                    ("dump.json", {'compress': 'gzip'}, gzip.open)):
+                path = os.path.join(directory, name)
+                output = StringIO()
+                call_command("object_dump", "simpleapp.taggedarticle", output=path,
+                             buffer_size=100, stdout=output, **options)
+                self.assertEqual(output.getvalue(), "")
+                with open_file(path, 'rt', encoding='utf-8') as dump:
+                    self.assertEqual(dump.read(), expected.getvalue())
+
+    def test_compress_needs_output(self):
+        with self.assertRaises(CommandError):
+            call_command("object_dump", "simpleapp.taggedarticle", compress='gzip', stdout=StringIO())
+
+
+class ShardedOutputTestCase(TaggedDumpMixin, CommonObjectDumpTestCase):
+    def read_shards(self, directory, open_file=open):
+        with open(os.path.join(directory, 'manifest.json')) as f:
+            manifest = json.load(f)
+        shards = []
+        for shard in manifest['shards']:
+            path = os.path.join(directory, shard['file'])
+            with open(path, 'rb') as f:
+                self.assertEqual(hashlib.sha256(f.read()).hexdigest(), shard['sha256'])
+            with open_file(path, 'rt', encoding='utf-8') as f:
+                objects = [json.loads(line) for line in f] if manifest['format'] == 'jsonl' else json.load(f)
+            self.assertEqual(len(objects), shard['objects'])
+            self.assertEqual(set(item['model'] for item in objects), set(shard['models']))
+            shards.append((shard, path, objects))
+        return manifest, shards
+
+    def test_shards(self):
+        expected = json.loads(self.dump("simpleapp.taggedarticle"))
+        for order in ('object', 'model'):
+            with tempfile.TemporaryDirectory() as directory:
+                self.dump("simpleapp.taggedarticle", order=order, shard_dir=directory,
+                          shard_objects=2, compress='gzip')
+                manifest, shards = self.read_shards(directory, gzip.open)
+                self.assertEqual(manifest['cyclic_layers'], [])
+                layers = {}
+                for shard, path, objects in shards:
+                    self.assertLessEqual(len(objects), 2)
+                    for item in objects:
+                        layers[(item['model'], item['pk'])] = shard['layer']
+                self.assertEqual(sorted(layers), sorted((item['model'], item['pk']) for item in expected))
+                for item in expected:
+                    if item['model'] == 'simpleapp.taggedarticle':
+                        self.assertLess(layers[('simpleapp.author', item['fields']['author'])],
+                                        layers[('simpleapp.taggedarticle', item['pk'])])
+
+                TaggedItem.objects.all().delete()
+                TaggedArticle.objects.all().delete()
+                Author.objects.all().delete()
+                for layer in sorted(set(layers.values())):
+                    call_command("loaddata", *[path for shard, path, objects in shards
+                                               if shard['layer'] == layer], verbosity=0)
+                self.assertEqual(TaggedItem.objects.count(), 5)
+                self.assertEqual(AuthorProfile.objects.count(), 3)
+
+    def test_shard_size(self):
+        with tempfile.TemporaryDirectory() as directory, \
+                mock.patch.object(settings, 'CHUNK_SIZE', 1):
+            self.dump("simpleapp.author", format="jsonl", shard_dir=directory, shard_size=1)
+            manifest, shards = self.read_shards(directory)
+        self.assertEqual([shard['objects'] for shard, path, objects in shards],
+                         [1] * len(shards))
+        self.assertEqual(len(shards), len(set(
+            (item['model'], item['pk']) for shard, path, objects in shards for item in objects)))
+
+    def test_cyclic_layer(self):
+        e1 = Employee.objects.create(name="Ann")
+        e2 = Employee.objects.create(name="Bob", mentor=e1)
+        e1.mentor = e2
+        e1.save()
+        with tempfile.TemporaryDirectory() as directory:
+            self.dump("simpleapp.employee", shard_dir=directory)
+            manifest, shards = self.read_shards(directory)
+        self.assertEqual([shard['layer'] for shard, path, objects in shards], [0])
+        self.assertEqual(manifest['cyclic_layers'], [0])
+
+        with tempfile.TemporaryDirectory() as directory:
+            self.dump("simpleapp.employee", shard_dir=directory, breakcycles=True)
+            manifest, shards = self.read_shards(directory)
+        self.assertEqual([shard['layer'] for shard, path, objects in shards], [0, 1, 2])
+        self.assertEqual(manifest['cyclic_layers'], [])
+        self.assertIsNone(shards[0][2][0]['fields']['mentor'])
+        self.assertEqual(shards[2][2][0]['pk'], shards[0][2][0]['pk'])
+
+
+class ObjectLoadTestCase(TaggedDumpMixin, CommonObjectDumpTestCase):
+    databases = {'default', 'other'}
+    # The content types are already in the database.
+    dump_options = {'exclude': ['contenttypes']}
+
+    def delete_all(self):
+        for model in (TaggedItem, TaggedArticle, AuthorProfile, Author, Category, Tag, Employee):
+            model.objects.all().delete()
+
+    def test_round_trip(self):
+        expected = self.dump("simpleapp.taggedarticle")
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'dump.json.gz')
+            self.dump("simpleapp.taggedarticle", output=path)
+            self.delete_all()
+            output = StringIO()
+            with CaptureQueriesContext(connection) as queries:
+                call_command("object_load", path, stdout=output)
+        self.assertEqual(output.getvalue(), "Installed %d object(s) from 1 fixture(s)\n"
+                         % len(json.loads(expected)))
+        inserts = [query for query in queries if query['sql'].startswith('INSERT')]
+        # One insert per run of objects of a model, and for the categories.
+        self.assertLess(len(inserts), len(json.loads(expected)))
+        self.assertEqual(self.dump("simpleapp.taggedarticle"), expected)
+        self.assertEqual(list(self.ar1.categories.all()), [self.c1])
+
+    def test_shards_and_deferred_foreign_keys(self):
+        e1 = Employee.objects.create(name="Ann")
+        e2 = Employee.objects.create(name="Bob", mentor=e1)
+        e1.mentor = e2
+        e1.save()
+        expected = self.dump("simpleapp.employee")
+        with tempfile.TemporaryDirectory() as directory:
+            self.dump("simpleapp.employee", breakcycles=True, shard_dir=directory)
+            self.delete_all()
+            call_command("object_load", directory, stdout=StringIO())
+        self.assertEqual(self.dump("simpleapp.employee"), expected)
+        self.assertEqual(Employee.objects.get(pk=e1.pk).mentor_id, e2.pk)
+
+    def test_invalid_foreign_key(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'dump.jsonl')
+            self.dump("simpleapp.taggedarticle", "1", format="jsonl", output=path)
+            self.delete_all()
+            with open(path) as f:
+                lines = [line for line in f if '"simpleapp.author"' not in line]
+            with open(path, 'w') as f:
+                f.writelines(lines)
+            with self.assertRaises(CommandError):
+                call_command("object_load", path, stdout=StringIO())
+        self.assertFalse(TaggedArticle.objects.exists())
+
+    def test_conflict(self):
+        expected = self.dump("simpleapp.taggedarticle")
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'dump.json')
+            self.dump("simpleapp.taggedarticle", output=path)
+            Author.objects.filter(pk=self.a1.pk).update(name="Changed")
+            self.ar1.categories.clear()
+            with self.assertRaises(CommandError):
+                call_command("object_load", path, stdout=StringIO())
+
+            Tag.objects.filter(pk=self.t3.pk).delete()
+            output = StringIO()
+            call_command("object_load", path, conflict="skip", stdout=output)
+            # Only the deleted tag and its tagged item are written.
+            self.assertEqual(output.getvalue(), "Installed 2 object(s) (of %d) from 1 fixture(s)\n"
+                             % len(json.loads(expected)))
+            self.assertEqual(Author.objects.get(pk=self.a1.pk).name, "Changed")
+            self.assertFalse(self.ar1.categories.exists())
+
+            call_command("object_load", path, conflict="update", stdout=StringIO())
+        self.assertEqual(self.dump("simpleapp.taggedarticle"), expected)
+
+    def test_skip_with_breakcycles(self):
+        e1 = Employee.objects.create(name="Ann")
+        e2 = Employee.objects.create(name="Bob", mentor=e1)
+        e1.mentor = e2
+        e1.save()
+        Employee.objects.using("other").create(pk=e1.pk, name="OTHER-1")
+        self.dump("simpleapp.employee", breakcycles=True, copy_to="other", conflict="skip")
+        kept = Employee.objects.using("other").get(pk=e1.pk)
+        self.assertEqual((kept.name, kept.mentor_id), ("OTHER-1", None))
+        self.assertEqual(Employee.objects.using("other").get(pk=e2.pk).mentor_id, e1.pk)
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'employees.json')
+            self.dump("simpleapp.employee", breakcycles=True, output=path)
+            Employee.objects.filter(pk=e1.pk).update(name="Kept", mentor=None)
+            call_command("object_load", path, conflict="skip", stdout=StringIO())
+        kept = Employee.objects.get(pk=e1.pk)
+        self.assertEqual((kept.name, kept.mentor_id), ("Kept", None))
+
+    def test_remap_pks(self):
+        self.addCleanup(setattr, settings, 'PK_MAP_SIZE', settings.PK_MAP_SIZE)
+        # Move the keys to disk as soon as there are two.
+        settings.PK_MAP_SIZE = 1
+        e1 = Employee.objects.create(name="Ann")
+        e2 = Employee.objects.create(name="Bob", mentor=e1)
+        e1.mentor = e2
+        e1.save()
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'dump.json')
+            self.dump("simpleapp.taggedarticle", "1", output=path)
+            call_command("object_load", path, remap_pks=True, stdout=StringIO())
+            path = os.path.join(directory, 'employees.json')
+            self.dump("simpleapp.employee", breakcycles=True, output=path)
+            call_command("object_load", path, remap_pks=True, stdout=StringIO())
+
+        article = TaggedArticle.objects.latest('pk')
+        self.assertNotEqual(article.pk, self.ar1.pk)
+        self.assertEqual(article.headline, self.ar1.headline)
+        self.assertNotEqual(article.author_id, self.a1.pk)
+        self.assertEqual(article.author.name, self.a1.name)
+        self.assertEqual(article.author.authorprofile.date_of_birth, self.ap1.date_of_birth)
+        categories = list(article.categories.all())
+        self.assertEqual([category.name for category in categories], [self.c1.name])
+        self.assertNotEqual(categories[0].pk, self.c1.pk)
+        items = TaggedItem.objects.filter(object_id=article.pk).order_by('pk')
+        self.assertEqual([item.content_object for item in items], [article, article])
+        self.assertEqual([item.tag.name for item in items], [self.t1.name, self.t2.name])
+        self.assertEqual(TaggedItem.objects.filter(object_id=self.ar1.pk).count(), 2)
+
+        ann, bob = Employee.objects.order_by('-pk')[:2][::-1]
+        self.assertNotIn(ann.pk, (e1.pk, e2.pk))
+        self.assertEqual((ann.name, ann.mentor_id), ("Ann", bob.pk))
+        self.assertEqual((bob.name, bob.mentor_id), ("Bob", ann.pk))
+
+    def test_remap_pks_forward_references(self):
+        e1 = Employee.objects.create(name="Ann")
+        e2 = Employee.objects.create(name="Bob", mentor=e1)
+        e1.mentor = e2
+        e1.save()
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'employees.json')
+            # Without --breakcycles, the first employee points at the second,
+            # which is in the next batch.
+            self.dump("simpleapp.employee", output=path)
+            call_command("object_load", path, remap_pks=True, batch_size=1, stdout=StringIO())
+
+        self.assertEqual(Employee.objects.count(), 4)
+        ann = Employee.objects.exclude(pk=e1.pk).get(name="Ann")
+        bob = Employee.objects.exclude(pk=e2.pk).get(name="Bob")
+        self.assertEqual((ann.mentor_id, bob.mentor_id), (bob.pk, ann.pk))
+        self.assertEqual(Employee.objects.get(pk=e1.pk).mentor_id, e2.pk)
+
+    def test_copy_to(self):
+        e1 = Employee.objects.create(name="Ann")
+        e2 = Employee.objects.create(name="Bob", mentor=e1)
+        e1.mentor = e2
+        e1.save()
+        expected = self.dump("simpleapp.taggedarticle")
+        self.dump("simpleapp.taggedarticle", copy_to="other")
+        self.assertEqual(self.dump("simpleapp.taggedarticle", database="other"), expected)
+        self.assertEqual(list(TaggedArticle.objects.using("other").get(pk=self.ar1.pk).categories.all()),
+                         [self.c1])
+
+        expected = self.dump("simpleapp.employee")
+        self.dump("simpleapp.employee", breakcycles=True, copy_to="other")
+        self.assertEqual(self.dump("simpleapp.employee", database="other"), expected)
+
+        with self.assertRaises(CommandError):
+            self.dump("simpleapp.employee", breakcycles=True, copy_to="other")
+        self.dump("simpleapp.employee", breakcycles=True, copy_to="other", conflict="skip")
+        self.assertEqual(Employee.objects.using("other").count(), 2)
+
+
+class DeltaDumpTestCase(TaggedDumpMixin, CommonObjectDumpTestCase):
+    databases = {'default', 'other'}
+    dump_options = {'exclude': ['contenttypes']}
+
+    def dump_keys(self, *args, **options):
+        return sorted((obj['model'], obj['pk']) for obj in json.loads(self.dump(*args, **options)))
+
+    def test_delta(self):
+        with tempfile.TemporaryDirectory() as directory:
+            first, second, third = [os.path.join(directory, name) for name in ('1.json', '2.json', '3.json')]
+            self.assertEqual(len(self.dump_keys("simpleapp.taggedarticle", hash_manifest=first)), 20)
+            self.assertEqual(self.dump_keys("simpleapp.taggedarticle", since_manifest=first,
+                                            hash_manifest=second, batch=True), [])
+
+            Author.objects.filter(pk=self.a1.pk).update(name="Ben")
+            self.ar2.categories.add(self.c1)
+            ar3_pk = self.ar3.pk
+            self.ar3.delete()
+            self.assertEqual(
+                self.dump_keys("simpleapp.taggedarticle", since_manifest=second, hash_manifest=third),
+                [('simpleapp.author', self.a1.pk), ('simpleapp.taggedarticle', self.ar2.pk)])
+            with open(third) as f:
+                manifest = json.load(f)
+        # The objects only the deleted article led to are no longer dumped.
+        self.assertEqual(manifest['deleted'], {
+            'simpleapp.author': [str(self.a3.pk)],
+            'simpleapp.authorprofile': [str(self.a3.pk)],
+            'simpleapp.category': [str(self.c3.pk)],
+            'simpleapp.tag': [str(self.t3.pk)],
+            'simpleapp.taggedarticle': [str(ar3_pk)],
+            'simpleapp.taggeditem': [str(self.ti5.pk)],
+        })
+        self.assertEqual(len(manifest['objects']['simpleapp.taggedarticle']), 2)
+
+    def test_shards(self):
+        with tempfile.TemporaryDirectory() as directory:
+            hashes = os.path.join(directory, 'hashes.json')
+            self.dump("simpleapp.taggedarticle", hash_manifest=hashes)
+            TaggedArticle.objects.filter(pk=self.ar2.pk).update(headline="Changed")
+            shards = os.path.join(directory, 'shards')
+            self.dump("simpleapp.taggedarticle", since_manifest=hashes,
+                      hash_manifest=os.path.join(directory, 'new.json'), shard_dir=shards)
+            with open(os.path.join(shards, 'manifest.json')) as f:
+                manifest = json.load(f)
+        self.assertEqual(manifest['cyclic_layers'], [])
+        self.assertEqual([(shard['models'], shard['objects']) for shard in manifest['shards']],
+                         [(['simpleapp.taggedarticle'], 1)])
+
+    def test_load_delta(self):
+        with tempfile.TemporaryDirectory() as directory:
+            full, delta = os.path.join(directory, 'full.json'), os.path.join(directory, 'delta.json')
+            first, second = os.path.join(directory, '1.json'), os.path.join(directory, '2.json')
+            self.dump("simpleapp.taggedarticle", output=full, hash_manifest=first)
+            call_command("object_load", full, database="other", stdout=StringIO())
+
+            Author.objects.filter(pk=self.a1.pk).update(name="Ben")
+            self.ar3.delete()
+            self.dump("simpleapp.taggedarticle", output=delta, since_manifest=first, hash_manifest=second)
+            output = StringIO()
+            call_command("object_load", delta, database="other", conflict="update",
+                         deletions=second, stdout=output)
+        # The six objects, and the article's category row.
+        self.assertIn("Deleted 7 object(s)", output.getvalue())
+        self.assertEqual(self.dump("simpleapp.taggedarticle", database="other"),
+                         self.dump("simpleapp.taggedarticle"))
+
+    def test_hashes_traversed_objects(self):
+        with tempfile.TemporaryDirectory() as directory:
+            with CaptureQueriesContext(connection) as plain:
+                expected = self.dump("simpleapp.taggedarticle", batch=True)
+            with CaptureQueriesContext(connection) as hashed:
+                output = self.dump("simpleapp.taggedarticle", batch=True,
+                                   hash_manifest=os.path.join(directory, 'hashes.json'))
+        self.assertEqual(output, expected)
+        # The rows read to hash the deferred instances are the ones serialized.
+        self.assertLessEqual(len(hashed), len(plain))
+
+    def test_many2many_to_field(self):
+        # The through rows point at the team numbers, which are other teams' pks.
+        e1 = Employee.objects.create(name="Ann")
+        e2 = Employee.objects.create(name="Bob")
+        t1 = Team.objects.create(pk=1, number=2)
+        t2 = Team.objects.create(pk=2, number=1)
+        Membership.objects.create(team=t1, employee=e1)
+        Membership.objects.create(team=t2, employee=e2)
+        field = Team._meta.get_field('members')
+        teams = list(Team.objects.order_by('pk'))
+        m2m_pks = {}
+        bulk_load_many2many(teams, field, m2m_pks, load_objects=False)
+        fetched = DeltaFilter(m2m_fields=lambda model: [field]).get_hashes(Team, teams)
+        known = DeltaFilter(m2m_fields=lambda model: [field], m2m_pks=m2m_pks).get_hashes(Team, teams)
+        self.assertEqual(known, fetched)
+        self.assertNotEqual(fetched[t1.pk], fetched[t2.pk])
+
+    def test_updated_at(self):
+        settings.MODEL_SETTINGS['simpleapp.taggedarticle']['updated_at'] = 'pub_date'
+        with tempfile.TemporaryDirectory() as directory:
+            first, second = os.path.join(directory, '1.json'), os.path.join(directory, '2.json')
+            self.dump("simpleapp.taggedarticle", hash_manifest=first)
+            TaggedArticle.objects.filter(pk=self.ar1.pk).update(headline="Changed")
+            TaggedArticle.objects.filter(pk=self.ar2.pk).update(
+                pub_date=datetime.datetime(2014, 1, 1, 12, 0, 0, 0, UTC))
+            self.assertEqual(
+                self.dump_keys("simpleapp.taggedarticle", since_manifest=first, hash_manifest=second),
+                [('simpleapp.taggedarticle', self.ar2.pk)])
+
+
+class IdentityMapTestCase(TaggedDumpMixin, CommonObjectDumpTestCase):
+    def test_least_recently_used_evicted(self):
+        identity_map = IdentityMap(2)
+        identity_map.add(self.c1)
+        identity_map.add(self.c2)
+        self.assertIs(identity_map.get(Category, self.c1.pk), self.c1)
+        identity_map.add(self.c3)
+        self.assertIsNone(identity_map.get(Category, self.c2.pk))
+        self.assertIs(identity_map.get(Category, self.c3.pk), self.c3)
+        self.assertEqual(len(identity_map), 2)
+        self.assertEqual((identity_map.hits, identity_map.misses), (2, 1))
+
+    def test_shared_rows_fetched_once(self):
+        for options in ({}, {'batch': True}):
+            expected = self.dump("simpleapp.taggedarticle", identity_map_size=0, **options)
+            with CaptureQueriesContext(connection) as uncached:
+                self.dump("simpleapp.taggedarticle", identity_map_size=0, **options)
+            with CaptureQueriesContext(connection) as cached:
+                self.assertEqual(self.dump("simpleapp.taggedarticle", **options), expected)
+            self.assertLess(len(cached), len(uncached))
+
+        with CaptureQueriesContext(connection) as queries:
+            self.dump("simpleapp.taggedarticle")
+        tag_queries = [q for q in queries if 'FROM "simpleapp_tag"' in q['sql']]
+        # The five tagged items point at three tags.
+        self.assertEqual(len(tag_queries), 3)
+
+    def test_verbose_counts(self):
+        stderr = StringIO()
+        self.dump("simpleapp.taggedarticle", verbosity=2, stderr=stderr)
+        self.assertIn("Identity map: ", stderr.getvalue())
@@ -0,0 +1,324 @@
+# -*- coding: utf-8 -*-
+"""
+Load the related objects of many instances at once, and put them in the
+instances' caches so accessing the relation doesn't query the database.
+"""
+from collections import defaultdict
+
+import django
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.db.models import F, Prefetch, Window, prefetch_related_objects
+from django.db.models.functions import RowNumber
+
+
+def restrict_fields(queryset, only=None, *required):
+    """
+    Restrict ``queryset`` to the fields ``only(model)`` names, plus the
+    ``required`` ones. ``None``, from ``only`` or as ``only``, loads all the
+    fields.
+    """
+    fields = only(queryset.model) if only is not None else None
+    if fields is None:
+        return queryset
+    return queryset.only(*(fields + required))
+
+
+def load_in_bulk(wanted, only=None, identity_map=None):
+    """
+    Load ``{(model, attname, db): values}`` with one ``in_bulk`` query per
+    key. Returns ``{(model, attname, db): {value: obj}}``. The objects are
+    added to ``identity_map``, if given.
+    """
+    loaded = {}
+    for key, values in wanted.items():
+        model, attname, db = key
+        queryset = restrict_fields(model._base_manager.using(db), only, attname)
+        loaded[key] = queryset.in_bulk(list(values), field_name=attname)
+        if identity_map is not None:
+            for obj in loaded[key].values():
+                identity_map.add(obj)
+    return loaded
+
+
+def bulk_load_foreignkeys(pairs, only=None, identity_map=None):
+    """
+    Load the targets of ``(obj, field)`` foreign key pairs in bulk.
+
+    The values are read from ``field.attname``, so no related instance is
+    loaded just to find out what it points to. Values are grouped by target
+    model, across fields and source models, and each target model is loaded
+    with one ``in_bulk`` query. Objects pointing at the same row share the
+    same related instance. ``only`` restricts the loaded fields, as in
+    ``restrict_fields``. Targets in the ``IdentityMap`` ``identity_map`` are
+    taken from it, and the loaded ones are added to it.
+    """
+    wanted = defaultdict(set)  # {(model, attname, db): set(values)}
+    pending = []
+    for obj, field in pairs:
+        if field.is_cached(obj):
+            continue
+        value = getattr(obj, field.attname)
+        if value is None:
+            continue
+        if (identity_map is not None and field.target_field.primary_key
+                and identity_map.cache_related(obj, field, field.related_model, value)):
+            continue
+        key = (field.related_model, field.target_field.attname, obj._state.db)
+        wanted[key].add(value)
+        pending.append((obj, field, key, value))
+
+    loaded = load_in_bulk(wanted, only, identity_map)
+    for obj, field, key, value in pending:
+        if value in loaded[key]:
+            field.set_cached_value(obj, loaded[key][value])
+
+
+def warm_content_types(ct_ids, ct_cache, using=None):
+    """
+    Add the models of the ``ct_ids`` missing from ``ct_cache`` (a
+    ``{content type id: model}`` dict) with one query
+    """
+    from django.contrib.contenttypes.models import ContentType
+
+    missing = set(ct_ids) - set(ct_cache)
+    if not missing:
+        return
+    for ct in ContentType.objects.db_manager(using).filter(pk__in=missing):
+        ct_cache[ct.pk] = ct.model_class()
+
+
+def bulk_load_genericforeignkeys(pairs, ct_cache, only=None, identity_map=None):
+    """
+    Load the targets of ``(obj, field)`` generic foreign key pairs in bulk.
+
+    The pairs are grouped by content type, and each content type is loaded
+    with one ``in_bulk`` query. The models of the content types come from
+    ``ct_cache``, which is warmed with one query for the unknown ids.
+    ``identity_map`` is used as in ``bulk_load_foreignkeys``.
+    """
+    by_db = defaultdict(set)
+    pending = []
+    for obj, field in pairs:
+        if field.is_cached(obj):
+            continue
+        ct_id = getattr(obj, obj._meta.get_field(field.ct_field).attname)
+        value = getattr(obj, field.fk_field)
+        if ct_id is None or value is None:
+            continue
+        by_db[obj._state.db].add(ct_id)
+        pending.append((obj, field, ct_id, value))
+    for db, ct_ids in by_db.items():
+        warm_content_types(ct_ids, ct_cache, db)
+
+    wanted = defaultdict(set)
+    resolved = []
+    for obj, field, ct_id, value in pending:
+        model = ct_cache.get(ct_id)
+        if model is None:  # stale content type
+            continue
+        value = model._meta.pk.to_python(value)
+        if identity_map is not None and identity_map.cache_related(obj, field, model, value):
+            continue
+        key = (model, model._meta.pk.attname, obj._state.db)
+        wanted[key].add(value)
+        resolved.append((obj, field, key, value))
+
+    loaded = load_in_bulk(wanted, only, identity_map)
+    for obj, field, key, value in resolved:
+        if value in loaded[key]:
+            field.set_cached_value(obj, loaded[key][value])
+
+
+def supports_window_prefetch(using):
+    """
+    Can a sliced queryset be prefetched on the ``using`` database?
+
+    Since Django 4.2 the slice is applied to each parent separately, with
+    ``ROW_NUMBER() OVER (PARTITION BY fk)``, which needs window functions.
+    """
+    return (django.VERSION >= (4, 2)
+            and connections[using].features.supports_over_clause)
+
+
+def prefetch_attr(accessor):
+    """
+    Name of the instance attribute ``bulk_load_reverse`` stores
+    ``accessor``'s related objects in
+    """
+    return '_objectdump_%s' % accessor
+
+
+def bulk_load_reverse(objs, rel, limit=None, chunk_size=None, only=None):
+    """
+    Load the reverse relation ``rel`` (a ``ForeignObjectRel``) for ``objs``.
+
+    The related objects are stored on each instance in the
+    ``prefetch_attr(accessor)`` attribute: a list, or the object (or
+    ``None``) for one-to-one relations. With a ``limit`` each parent gets at
+    most ``limit`` related rows, in the related model's default ordering,
+    like ``manager.all()[:limit]``. Where the database supports it the limit
+    is enforced in SQL. Otherwise the parents are prefetched ``chunk_size``
+    at a time and each list is trimmed in Python.
+    """
+    if not objs:
+        return
+    accessor = rel.get_accessor_name()
+    attr = prefetch_attr(accessor)
+    using = objs[0]._state.db or DEFAULT_DB_ALIAS
+    queryset = restrict_fields(
+        rel.related_model._default_manager.using(using).all(), only, rel.field.name)
+    if limit and rel.multiple and supports_window_prefetch(using):
+        prefetch_related_objects(
+            objs, Prefetch(accessor, queryset=queryset[:limit], to_attr=attr))
+        return
+    for chunk in chunked(objs, chunk_size):
+        prefetch_related_objects(
+            chunk, Prefetch(accessor, queryset=queryset, to_attr=attr))
+        if limit and rel.multiple:
+            for obj in chunk:
+                setattr(obj, attr, getattr(obj, attr)[:limit])
+
+
+def get_ordering(model, prefix):
+    """
+    The default ordering of ``model``, as seen through the ``prefix`` relation
+    """
+    ordering = []
+    for item in model._meta.ordering:
+        if not isinstance(item, str) or item == '?':
+            continue
+        if item.startswith('-'):
+            ordering.append('-%s__%s' % (prefix, item[1:]))
+        else:
+            ordering.append('%s__%s' % (prefix, item))
+    return ordering
+
+
+def bulk_load_many2many(objs, field, m2m_pks, load_objects=True, chunk_size=None,
+                        only=None):
+    """
+    Read the through table of the many-to-many ``field`` once for ``objs``.
+
+    The related primary keys are stored in ``m2m_pks[field][obj.pk]``, in the
+    related model's default ordering, for the serializer to use. With
+    ``load_objects`` the related objects are also loaded, with one query, and
+    stored in the ``prefetch_attr(field.name)`` list of each instance, with
+    the fields ``only`` allows, as in ``restrict_fields``.
+    """
+    if not objs:
+        return
+    through = field.remote_field.through
+    source = through._meta.get_field(field.m2m_field_name())
+    target = through._meta.get_field(field.m2m_reverse_field_name())
+    using = objs[0]._state.db or DEFAULT_DB_ALIAS
+
+    by_source = dict(
+        (getattr(obj, source.target_field.attname), obj.pk) for obj in objs)
+    related = fetch_many2many_keys(field, list(by_source), using, chunk_size)
+    field_pks = m2m_pks.setdefault(field, {})
+    for source_value, pk in by_source.items():
+        field_pks[pk] = related[source_value]
+
+    if not load_objects:
+        return
+    key = (field.related_model, target.target_field.attname, using)
+    wanted = {key: set()}
+    for obj in objs:
+        wanted[key].update(field_pks[obj.pk])
+    loaded = load_in_bulk(wanted, only)[key]
+    for obj in objs:
+        setattr(obj, prefetch_attr(field.name),
+                [loaded[value] for value in field_pks[obj.pk] if value in loaded])
+
+
+def chunked(values, chunk_size=None):
+    """
+    Split the ``values`` list in lists of at most ``chunk_size`` items
+    """
+    chunk_size = chunk_size or len(values) or 1
+    for start in range(0, len(values), chunk_size):
+        yield values[start:start + chunk_size]
+
+
+def fetch_rows(model, pks, columns, using=None, chunk_size=None):
+    """
+    Return ``{pk: {column: value}}`` with the ``columns`` (attnames) of the
+    ``model`` rows in ``pks``, without creating any model instance
+    """
+    # The primary key may also be a relation column, e.g. a OneToOneField.
+    pk_attname = model._meta.pk.attname
+    fields = [pk_attname] + [column for column in columns if column != pk_attname]
+    rows = {}
+    for chunk in chunked(pks, chunk_size):
+        queryset = model._base_manager.using(using).filter(pk__in=chunk)
+        for row in queryset.values_list(*fields):
+            rows[row[0]] = dict(zip(fields, row))
+    return rows
+
+
+def fetch_pks(model, attname, values, using=None, chunk_size=None):
+    """
+    Return ``{value: pk}`` for the ``model`` rows whose ``attname`` column is
+    in ``values``. Primary key values are returned as they are.
+    """
+    if attname == model._meta.pk.attname:
+        return dict((value, value) for value in values)
+    pks = {}
+    for chunk in chunked(values, chunk_size):
+        queryset = model._base_manager.using(using).filter(**{'%s__in' % attname: chunk})
+        pks.update(queryset.values_list(attname, 'pk'))
+    return pks
+
+
+def fetch_reverse_keys(rel, values, limit=None, using=None, chunk_size=None):
+    """
+    Return ``{parent value: [related pk, ...]}`` for the reverse relation
+    ``rel`` of the parents whose target field is in ``values``.
+
+    Like ``bulk_load_reverse``, ``limit`` is applied to each parent, in the
+    related model's default ordering: in SQL with ``ROW_NUMBER()`` where
+    supported, in Python otherwise.
+    """
+    attname = rel.field.attname
+    queryset = rel.related_model._default_manager.using(using).all()
+    related = dict((value, []) for value in values)
+    if limit and supports_window_prefetch(using):
+        order_by = [
+            expr for expr, _ in queryset.query.get_compiler(using=using).get_order_by()]
+        queryset = queryset.annotate(_objectdump_row=Window(
+            RowNumber(), partition_by=F(attname), order_by=order_by,
+        )).filter(_objectdump_row__lte=limit)
+    elif not limit:
+        queryset = queryset.order_by()
+    fields = [attname]
+    if attname != rel.related_model._meta.pk.attname:
+        fields.append('pk')
+    for chunk in chunked(values, chunk_size):
+        rows = queryset.filter(**{'%s__in' % attname: chunk}).values_list(*fields)
+        for row in rows:
+            related[row[0]].append(row[-1])
+    if limit:
+        for value, pks in related.items():
+            del pks[limit:]
+    return related
+
+
+def fetch_many2many_keys(field, values, using=None, chunk_size=None):
+    """
+    Return ``{source value: [related value, ...]}`` read from the through
+    table of the many-to-many ``field``, in the related model's default
+    ordering
+    """
+    through = field.remote_field.through
+    source = through._meta.get_field(field.m2m_field_name())
+    target = through._meta.get_field(field.m2m_reverse_field_name())
+    ordering = get_ordering(field.related_model, target.name)
+
+    related = dict((value, []) for value in values)
+    for chunk in chunked(values, chunk_size):
+        rows = through._base_manager.using(using).filter(**{
+            '%s__in' % source.attname: chunk
+        }).order_by(*ordering).values_list(source.attname, target.attname)
+        for source_value, target_value in rows:
+            related[source_value].append(target_value)
+    return related
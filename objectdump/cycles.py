@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+"""
+Find, describe and break the dependency cycles of an ``ObjectGraph``.
+"""
+from collections import Counter, defaultdict
+
+from .graph import DEPENDS
+from .topological_sort import strongly_connected_components
+
+
+def get_dependency_edges(graph, cut=()):
+    """
+    Return ``{node id: [(target id, edge index), ...]}`` for the dependency
+    edges of ``graph`` that aren't in ``cut``, without self dependencies
+    """
+    edges = defaultdict(list)
+    for index, flags in enumerate(graph.flags):
+        if flags & DEPENDS and index not in cut:
+            source = graph.sources[index]
+            target = graph.targets[index]
+            if source != target:
+                edges[source].append((target, index))
+    return edges
+
+
+def find_cycles(edges):
+    """
+    Return the node ids of each cycle of the ``get_dependency_edges`` edges
+    """
+    components = strongly_connected_components(
+        list(edges), lambda node: [target for target, index in edges.get(node, ())])
+    return [component for component in components if len(component) > 1]
+
+
+def describe_cycles(graph, edges, cycles):
+    """
+    Return one line per cycle, with its number of objects and how many of
+    its edges go through each ``app.model.field -> app.model`` relation
+    """
+    lines = []
+    for cycle in cycles:
+        members = set(cycle)
+        counts = Counter()
+        for node in cycle:
+            source = graph.objects[node]._meta.label_lower
+            for target, index in edges.get(node, ()):
+                if target not in members:
+                    continue
+                label = graph.labels[index]
+                counts["%s.%s -> %s" % (
+                    source, graph.label_names[label] if label >= 0 else '*',
+                    graph.objects[target]._meta.label_lower)] += 1
+        lines.append("%s objects: %s" % (len(cycle), ", ".join(
+            "%s (%s)" % (relation, count)
+            for relation, count in sorted(counts.items(), key=lambda item: (-item[1], item[0])))))
+    return lines
+
+
+def break_cycle(cycle, edges, cut, is_breakable):
+    """
+    Add edges of ``cycle`` that ``is_breakable(edge index)`` accepts to
+    ``cut``. Returns ``True`` if any was added.
+
+    The cycle is searched depth first. Breakable back edges are cut and the
+    search goes on. Otherwise the first breakable edge of the loop the back
+    edge closes is cut, and the search stops, as the search tree changed.
+    """
+    members = set(cycle)
+    start = cycle[0]
+    position = {start: 0}  # {node on the search path: its depth}
+    path = []  # the edges between the nodes on the search path
+    work = [(start, iter(edges.get(start, ())))]
+    visited = set([start])
+    broken = False
+    while work:
+        node, children = work[-1]
+        for target, index in children:
+            if target not in members or index in cut:
+                continue
+            if target in position:
+                if is_breakable(index):
+                    cut.add(index)
+                    broken = True
+                    continue
+                for edge in path[position[target]:]:
+                    if is_breakable(edge):
+                        cut.add(edge)
+                        return True
+            elif target not in visited:
+                visited.add(target)
+                position[target] = len(work)
+                path.append(index)
+                work.append((target, iter(edges.get(target, ()))))
+                break
+        else:
+            work.pop()
+            del position[node]
+            if path:
+                path.pop()
+    return broken
+
+
+def break_cycles(graph, is_breakable):
+    """
+    Return the indexes of the dependency edges of ``graph`` to leave out so
+    no cycle is left, only cutting edges ``is_breakable(edge index)`` accepts.
+    Cycles without any breakable edge are left as they are.
+    """
+    cut = set()
+    while True:
+        edges = get_dependency_edges(graph, cut)
+        broken = False
+        for cycle in find_cycles(edges):
+            if break_cycle(cycle, edges, cut, is_breakable):
+                broken = True
+        if not broken:
+            return cut
@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+"""
+Keep a manifest of the content hash of each object dumped, and leave out of
+the next dump the objects whose hash didn't change since.
+"""
+import hashlib
+import json
+from collections import defaultdict
+from itertools import groupby, islice
+
+from django.db import DEFAULT_DB_ALIAS, models
+
+# If importing MODEL_SETTINGS directly, the tests can't update the settings between tests.
+from . import settings
+from .bulk import fetch_many2many_keys
+
+
+def read_manifest(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def write_manifest(path, manifest):
+    with open(path, 'w') as f:
+        json.dump(manifest, f)
+
+
+def get_updated_at(model):
+    """
+    The ``updated_at`` field of ``model`` in ``MODEL_SETTINGS``, or ``None``
+    """
+    opts = model._meta
+    key = ".".join([opts.app_label, opts.model_name])
+    return settings.MODEL_SETTINGS.get(key, {}).get('updated_at')
+
+
+class DeltaFilter(object):
+    """
+    Filter a stream of objects, or ``ObjectKey``s, down to the ones that are
+    new or changed since the ``previous`` manifest.
+
+    The hash of an object is the SHA-1 of its concrete field values and of
+    the primary keys of its ``m2m_fields(model)``, or the value of its
+    ``updated_at`` field when ``MODEL_SETTINGS`` names one, in which case its
+    many-to-many rows aren't compared. It is computed from the instances the
+    traversal loaded, and the many-to-many keys in ``m2m_pks``. The values
+    of ``ObjectKey``s and of instances with deferred fields, and the missing
+    many-to-many keys, are read for ``chunk_size`` objects of a model at a
+    time.
+
+    ``unchanged(obj)`` is called with each object left out, like the
+    ``Layers`` of ``--shard-dir``, which must see every object to tell a
+    dependency left out from one not reached yet.
+    """
+    def __init__(self, previous=None, using=DEFAULT_DB_ALIAS, chunk_size=None, m2m_fields=None,
+                 unchanged=None, m2m_pks=None):
+        self.previous = (previous or {}).get('objects', {})
+        self.using = using
+        self.chunk_size = chunk_size
+        self.m2m_fields = m2m_fields or (lambda model: ())
+        self.on_unchanged = unchanged
+        self.m2m_pks = m2m_pks if m2m_pks is not None else {}
+        self.hashes = defaultdict(dict)  # {model label: {pk: hash}}
+        self.changed = 0
+        self.unchanged = 0
+
+    def __call__(self, objs):
+        for model, group in groupby(objs, key=lambda obj: obj._meta.model):
+            label = model._meta.label_lower
+            previous = self.previous.get(label, {})
+            hashes = self.hashes[label]
+            for chunk in iter(lambda: list(islice(group, self.chunk_size)), []):
+                chunk_hashes = self.get_hashes(model, chunk)
+                for obj in chunk:
+                    pk = str(obj.pk)
+                    hashes[pk] = chunk_hashes.get(obj.pk)
+                    if hashes[pk] is not None and previous.get(pk) == hashes[pk]:
+                        self.unchanged += 1
+                        if self.on_unchanged is not None:
+                            self.on_unchanged(obj)
+                    else:
+                        self.changed += 1
+                        yield obj
+
+    def get_rows(self, model, objs, columns):
+        """
+        Return the values of the ``columns`` attnames of ``objs``, which
+        include the primary key. The values read for instances with deferred
+        fields are loaded into them, so the serializer doesn't read them again.
+        """
+        rows = []
+        missing = {}
+        for obj in objs:
+            if isinstance(obj, models.Model) and not obj.get_deferred_fields():
+                rows.append(tuple(getattr(obj, attname) for attname in columns))
+            else:
+                missing[obj.pk] = obj
+        if missing:
+            pk_index = columns.index(model._meta.pk.attname)
+            for row in model._base_manager.using(self.using).filter(
+                    pk__in=list(missing)).values_list(*columns):
+                rows.append(row)
+                obj = missing[row[pk_index]]
+                if isinstance(obj, models.Model):
+                    obj.__dict__.update(zip(columns, row))
+        return rows
+
+    def get_related(self, field, values):
+        """
+        Return ``{pk: [related value, ...]}`` of the many-to-many ``field``
+        for ``values``, ``{pk: source value}``. ``m2m_pks`` is keyed by pk,
+        and the through table by the value of the field it points at.
+        """
+        known = self.m2m_pks.get(field, {})
+        related = dict((pk, known[pk]) for pk in values if pk in known)
+        missing = dict((pk, value) for pk, value in values.items() if pk not in related)
+        if missing:
+            fetched = fetch_many2many_keys(
+                field, list(set(missing.values())), self.using, self.chunk_size)
+            related.update((pk, fetched[value]) for pk, value in missing.items())
+        return related
+
+    def get_hashes(self, model, objs):
+        """
+        Return ``{pk: hash}`` of ``objs``, all of ``model``
+        """
+        pk_attname = model._meta.pk.attname
+        updated_at = get_updated_at(model)
+        if updated_at is not None:
+            rows = self.get_rows(
+                model, objs, [pk_attname, model._meta.get_field(updated_at).attname])
+            return dict((pk, str(value)) for pk, value in rows)
+
+        columns = [field.attname for field in model._meta.concrete_fields]
+        pk_index = columns.index(pk_attname)
+        rows = self.get_rows(model, objs, columns)
+        related = []
+        for field in self.m2m_fields(model):
+            through = field.remote_field.through
+            attname = through._meta.get_field(field.m2m_field_name()).target_field.attname
+            index = columns.index(attname)
+            related.append(self.get_related(
+                field, dict((row[pk_index], row[index]) for row in rows)))
+        hashes = {}
+        for row in rows:
+            m2m = [sorted(keys[row[pk_index]], key=str) for keys in related]
+            hashes[row[pk_index]] = hashlib.sha1(repr((row, m2m)).encode('utf-8')).hexdigest()
+        return hashes
+
+    def deletions(self):
+        """
+        Return ``{model label: [pk, ...]}`` of the objects in the previous
+        manifest that weren't dumped this time
+        """
+        deleted = {}
+        for label, previous in self.previous.items():
+            pks = [pk for pk in previous if pk not in self.hashes.get(label, {})]
+            if pks:
+                deleted[label] = pks
+        return deleted
+
+    def manifest(self):
+        return {
+            'objects': self.hashes,
+            'deleted': self.deletions(),
+        }
@@ -0,0 +1,260 @@
+# -*- coding: utf-8 -*-
+"""
+Serialize to the ``json`` and ``jsonl`` formats straight from ``values_list``
+rows, without model instances or the per-field serializer handlers.
+"""
+import abc
+import json
+from collections import namedtuple
+from io import StringIO
+from itertools import groupby, islice
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.core.serializers.json import Serializer as JSONSerializer
+from django.db import DEFAULT_DB_ALIAS
+from django.db.models import Field
+from django.utils.encoding import is_protected_type
+
+from .bulk import fetch_many2many_keys
+from .jsonl import Serializer as JSONLinesSerializer
+from .models import ObjectKey
+from .serializer import PerObjectSerializer, get_serializer
+
+# The internal types of the built-in fields whose values are output as they
+# are, and of those whose values ``DjangoJSONEncoder`` converts.
+NATIVE_TYPES = frozenset([
+    'AutoField', 'BigAutoField', 'SmallAutoField', 'IntegerField',
+    'BigIntegerField', 'SmallIntegerField', 'PositiveIntegerField',
+    'PositiveBigIntegerField', 'PositiveSmallIntegerField', 'BooleanField',
+    'NullBooleanField', 'FloatField',
+])
+ENCODED_TYPES = frozenset(['DateTimeField', 'DateField', 'TimeField', 'DecimalField'])
+
+encode_default = DjangoJSONEncoder().default
+
+
+def encode_protected(value):
+    """
+    What ``DjangoJSONEncoder`` outputs for a protected type value
+    """
+    if value is None or isinstance(value, (int, float)):
+        return value
+    return encode_default(value)
+
+
+class FieldValue(object):
+    """
+    A stand-in for an instance, with only the attribute of the field whose
+    ``value_to_string`` is called
+    """
+    def __init__(self, attname, value):
+        setattr(self, attname, value)
+
+
+def get_converter(field):
+    """
+    Return a function converting ``field`` values, as ``values_list`` reads
+    them, to what the json serializer outputs. ``None`` if they are output
+    as they are.
+    """
+    if field.is_relation:
+        # Foreign keys are output from their column, as the target's values.
+        target = field.target_field
+        while target.is_relation:
+            target = target.target_field
+        internal_type = target.get_internal_type()
+        to_string = str
+    else:
+        internal_type = field.get_internal_type()
+        if type(field).value_to_string is Field.value_to_string:
+            to_string = str
+        else:
+            def to_string(value):
+                return field.value_to_string(FieldValue(field.attname, value))
+    builtin = type(field).__module__.startswith('django.')
+    if builtin and internal_type in NATIVE_TYPES:
+        return None
+    if builtin and internal_type in ENCODED_TYPES:
+        return encode_protected
+
+    def convert(value):
+        if is_protected_type(value):
+            return encode_protected(value)
+        return to_string(value)
+    return convert
+
+
+class ModelEncoder(namedtuple('ModelEncoder', ['label', 'attnames', 'columns', 'm2m_fields'])):
+    """
+    The precompiled output of a model: the ``values_list`` columns, starting
+    with the primary key, ``(name, index, converter)`` of the serialized
+    columns and ``(field, converter)`` of the serialized many-to-many fields
+    """
+    __slots__ = ()
+
+    @classmethod
+    def compile(cls, model, selected_fields):
+        concrete_model = model._meta.concrete_model
+        pk = concrete_model._meta.pk
+        attnames = [pk.attname]
+        columns = [('pk', 0, get_converter(pk))]
+        for field in concrete_model._meta.local_fields:
+            if not field.serialize:
+                continue
+            name = field.attname[:-3] if field.is_relation else field.attname
+            if selected_fields is not None and name not in selected_fields:
+                continue
+            if field.attname not in attnames:
+                attnames.append(field.attname)
+            columns.append((field.name, attnames.index(field.attname), get_converter(field)))
+        m2m_fields = []
+        for field in concrete_model._meta.many_to_many:
+            if not field.serialize or not field.remote_field.through._meta.auto_created:
+                continue
+            if selected_fields is not None and field.attname not in selected_fields:
+                continue
+            m2m_fields.append((field, get_converter(field.related_model._meta.pk)))
+        return cls(str(model._meta), attnames, columns, m2m_fields)
+
+    def encode(self, row, related):
+        """
+        Return the dump object of a ``values_list`` row, with the
+        ``{m2m field: [related pks]}`` of the object
+        """
+        values = {}
+        for name, index, converter in self.columns:
+            value = row[index]
+            values[name] = value if converter is None else converter(value)
+        for field, converter in self.m2m_fields:
+            pks = related[field]
+            values[field.name] = pks if converter is None else [converter(pk) for pk in pks]
+        pk = values.pop('pk')
+        return {"model": self.label, "pk": pk, "fields": values}
+
+
+class RowSerializer(PerObjectSerializer, abc.ABC):
+    """
+    Output the same as the serializer it is mixed with, from the rows of the
+    objects.
+
+    Consecutive objects of a model are read ``chunk_size`` at a time with one
+    ``values_list`` query, unless they are instances with all their fields
+    loaded, and their many-to-many fields with one query each. The columns
+    and their conversions are worked out once per model.
+    """
+    def serialize(self, queryset, **options):
+        """
+        Serialize objects or ``ObjectKey``s. Takes the ``PerObjectSerializer``
+        options, but no natural keys, and ``using`` and ``chunk_size``.
+        """
+        self.stream = options.pop("stream", StringIO())
+        self.using = options.pop("using", None) or DEFAULT_DB_ALIAS
+        self.chunk_size = options.pop("chunk_size", None)
+        included_fields = options.pop("fields", {})
+        excluded_fields = options.pop("exclude_fields", {})
+        self.m2m_pks = options.pop("m2m_pks", {})
+        self.options = options
+        self.use_gfks = False
+        self.cached_selected_fields = {}
+        encoders = {}
+
+        self.start_serialization()
+        self.first = True
+        for model, group in groupby(queryset, key=lambda obj: obj._meta.model):
+            # Each chunk is written before the next one is read.
+            for chunk in iter(lambda: list(islice(group, self.chunk_size)), []):
+                if model not in encoders:
+                    encoders[model] = ModelEncoder.compile(model, self.get_selected_fields(
+                        chunk[0], included_fields, excluded_fields))
+                self.write_objects(list(self.encode_chunk(model, encoders[model], chunk)))
+        self.end_serialization()
+        return self.getvalue()
+
+    def get_rows(self, model, encoder, objs):
+        """
+        Return ``{pk: row}`` of ``objs``, read from the instances that have
+        all their fields loaded, and from the database for the others
+        """
+        rows = {}
+        missing = []
+        for obj in objs:
+            if isinstance(obj, ObjectKey) or obj.get_deferred_fields():
+                missing.append(obj.pk)
+            else:
+                rows[obj.pk] = tuple(getattr(obj, attname) for attname in encoder.attnames)
+        if missing:
+            queryset = model._base_manager.using(self.using).filter(pk__in=missing)
+            for row in queryset.values_list(*encoder.attnames):
+                rows[row[0]] = row
+        return rows
+
+    def get_related(self, field, pks):
+        """
+        Return ``{pk: [related pks]}`` of the many-to-many ``field``, from
+        ``m2m_pks`` or from its through table
+        """
+        known = self.m2m_pks.get(field, {})
+        related = dict((pk, known[pk]) for pk in pks if pk in known)
+        missing = [pk for pk in pks if pk not in related]
+        if missing:
+            related.update(fetch_many2many_keys(field, missing, self.using, self.chunk_size))
+        return related
+
+    def encode_chunk(self, model, encoder, objs):
+        """
+        Yield the dump objects of ``objs``, in order
+        """
+        rows = self.get_rows(model, encoder, objs)
+        pks = [obj.pk for obj in objs if obj.pk in rows]
+        m2m = dict((field, self.get_related(field, pks)) for field, _ in encoder.m2m_fields)
+        for pk in pks:
+            yield encoder.encode(
+                rows[pk], dict((field, related[pk]) for field, related in m2m.items()))
+
+    @abc.abstractmethod
+    def write_objects(self, objects):
+        """
+        Write the dump objects of a chunk
+        """
+
+
+class FastJSONSerializer(RowSerializer, JSONSerializer):
+    def write_objects(self, objects):
+        # The same separators as ``end_object``.
+        if not objects:
+            return
+        if self.options.get("indent"):
+            for data in objects:
+                self.stream.write("\n" if self.first else ",\n")
+                self.stream.write(json.dumps(data, **self.json_kwargs))
+                self.first = False
+            return
+        # Without indent a list is encoded with the same ", " between items.
+        if not self.first:
+            self.stream.write(", ")
+        self.stream.write(json.dumps(objects, **self.json_kwargs)[1:-1])
+        self.first = False
+
+
+class FastJSONLinesSerializer(RowSerializer, JSONLinesSerializer):
+    def write_objects(self, objects):
+        self.stream.write("".join(
+            json.dumps(data, **self.json_kwargs) + "\n" for data in objects))
+
+
+FAST_SERIALIZERS = {
+    JSONSerializer: FastJSONSerializer,
+    JSONLinesSerializer: FastJSONLinesSerializer,
+}
+
+
+def get_fast_serializer(format='json', use_natural_keys=False):
+    """
+    Return a ``RowSerializer`` for ``format``, or ``None`` if there is none
+    """
+    if use_natural_keys:
+        return None
+    for base in get_serializer(format).__bases__:
+        if base in FAST_SERIALIZERS:
+            return FAST_SERIALIZERS[base]()
+    return None
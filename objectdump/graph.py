@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+"""
+The objects found while traversing and the relations between them.
+"""
+from array import array
+from collections import defaultdict
+
+GENERATES = 1  # the source caused the target to be included
+LABELLED = 2  # shown as a field of the source in the debug output and diagrams
+DEPENDS = 4  # the source is serialized after the target
+WAITS = 8  # the source is serialized after the target, if the target is serialized
+
+
+class ObjectGraph(object):
+    """
+    Each object is interned once to a dense integer id. The edges are kept in
+    parallel ``array`` columns (source, target, label, flags) instead of dicts
+    of sets of objects and key strings. Labels are interned too.
+    """
+    def __init__(self):
+        self.ids = {}  # {(concrete model, pk): id}
+        self.objects = []  # {id: object}
+        self.visited = bytearray()  # 1 once the traversal reached the object
+        self.included = bytearray()  # 1 if the object is serialized
+        self.sources = array('i')
+        self.targets = array('i')
+        self.labels = array('i')  # -1 for no label
+        self.flags = array('B')
+        self.label_ids = {}
+        self.label_names = []
+
+    def __len__(self):
+        return len(self.objects)
+
+    def intern(self, obj):
+        """
+        Return the id of ``obj``, adding it if it is new
+        """
+        node = (obj._meta.concrete_model, obj.pk)
+        try:
+            return self.ids[node]
+        except KeyError:
+            node_id = self.ids[node] = len(self.objects)
+            self.objects.append(obj)
+            self.visited.append(0)
+            self.included.append(0)
+            return node_id
+
+    def visit(self, obj):
+        """
+        Mark ``obj`` as reached. Returns ``False`` if it already was.
+        """
+        node_id = self.intern(obj)
+        if self.visited[node_id]:
+            return False
+        self.visited[node_id] = 1
+        return True
+
+    def add_object(self, obj):
+        """
+        Include ``obj`` in the serialization. It replaces the object the id
+        was interned with, so the traversed instance is the one serialized.
+        """
+        node_id = self.intern(obj)
+        self.objects[node_id] = obj
+        self.included[node_id] = 1
+        return node_id
+
+    def include(self, obj):
+        """
+        Include ``obj`` in the serialization, keeping the object the id was
+        interned with
+        """
+        node_id = self.intern(obj)
+        self.included[node_id] = 1
+        return node_id
+
+    def included_objects(self):
+        """
+        Yield the serialized objects, in id order
+        """
+        for node_id, included in enumerate(self.included):
+            if included:
+                yield self.objects[node_id]
+
+    def intern_label(self, label):
+        if label is None:
+            return -1
+        try:
+            return self.label_ids[label]
+        except KeyError:
+            label_id = self.label_ids[label] = len(self.label_names)
+            self.label_names.append(label)
+            return label_id
+
+    def add_edge(self, source, target, label=None, flags=GENERATES):
+        """
+        Add an edge from the object ``source`` to the object ``target``.
+        Both ends of a ``DEPENDS`` edge are serialized.
+        """
+        source_id = self.intern(source)
+        target_id = self.intern(target)
+        self.sources.append(source_id)
+        self.targets.append(target_id)
+        self.labels.append(self.intern_label(label))
+        self.flags.append(flags)
+        if flags & DEPENDS:
+            self.included[source_id] = 1
+            self.included[target_id] = 1
+
+    def edges(self, flag):
+        """
+        Yield ``(source id, target id, label id)`` of the edges with ``flag``
+        """
+        for index, flags in enumerate(self.flags):
+            if flags & flag:
+                yield self.sources[index], self.targets[index], self.labels[index]
+
+    def dependencies(self, cut=()):
+        """
+        Return ``{object: set(objects it depends on)}`` for all the
+        serialized objects, in id order, leaving out the edge indexes in
+        ``cut``
+        """
+        depends_on = dict((obj, set()) for obj in self.included_objects())
+        for index, flags in enumerate(self.flags):
+            if flags & DEPENDS and index not in cut:
+                depends_on[self.objects[self.sources[index]]].add(
+                    self.objects[self.targets[index]])
+        return depends_on
+
+    def get_keys(self, get_key):
+        """
+        Return a function mapping ids to ``get_key(object)``, computed once
+        per id
+        """
+        keys = {}
+
+        def key(node_id):
+            try:
+                return keys[node_id]
+            except KeyError:
+                value = keys[node_id] = get_key(self.objects[node_id])
+                return value
+        return key
+
+    def generates(self, get_key):
+        """
+        Return ``{key: set(keys)}`` of the objects each object caused to be
+        included, with ``get_key(object)`` keys
+        """
+        key = self.get_keys(get_key)
+        generates = defaultdict(set)
+        for source, target, label in self.edges(GENERATES):
+            generates[key(source)].add(key(target))
+        return dict(generates)
+
+    def relationships(self, get_key):
+        """
+        Return ``{key: {label: set(keys)}}`` of the labelled edges, with
+        ``get_key(object)`` keys
+        """
+        key = self.get_keys(get_key)
+        relationships = defaultdict(lambda: defaultdict(set))
+        for source, target, label in self.edges(LABELLED):
+            relationships[key(source)][self.label_names[label]].add(key(target))
+        return relationships
+
+
+class OnlineOrder(object):
+    """
+    Emit the objects of an ``ObjectGraph`` while it is being built.
+
+    An object is emitted once it is resolved, i.e. all its relations have
+    been followed, and all the objects it depends on have been emitted.
+    An object with ``WAITS`` edges is held back until their targets have
+    been emitted, or to the end when they aren't serialized. Emitted objects
+    are released from the graph.
+    """
+    def __init__(self, graph):
+        self.graph = graph
+        self.position = 0  # the edges before it have been read
+        self.pending = []  # {id: number of dependencies not emitted yet}
+        self.waiting = defaultdict(list)  # {id: [ids of dependents]}
+        self.resolved = bytearray()
+        self.emitted = bytearray()
+
+    def read_edges(self):
+        graph = self.graph
+        missing = len(graph) - len(self.pending)
+        self.pending.extend([0] * missing)
+        self.resolved.extend(bytes(missing))
+        self.emitted.extend(bytes(missing))
+        for index in range(self.position, len(graph.flags)):
+            if not graph.flags[index] & (DEPENDS | WAITS):
+                continue
+            source = graph.sources[index]
+            target = graph.targets[index]
+            # A dependency found after its source was emitted can't be kept.
+            if source == target or self.emitted[source] or self.emitted[target]:
+                continue
+            self.pending[source] += 1
+            self.waiting[target].append(source)
+        self.position = len(graph.flags)
+
+    def resolve(self, obj):
+        """
+        Mark ``obj`` as resolved and yield the objects that can be emitted
+        """
+        self.read_edges()
+        node_id = self.graph.intern(obj)
+        self.resolved[node_id] = 1
+        if not self.pending[node_id]:
+            for obj in self.emit(node_id):
+                yield obj
+
+    def emit(self, node_id):
+        ready = [node_id]
+        for node_id in ready:
+            obj = self.graph.objects[node_id]
+            self.graph.objects[node_id] = None
+            self.emitted[node_id] = 1
+            if self.graph.included[node_id]:
+                yield obj
+            for dependent in self.waiting.pop(node_id, ()):
+                self.pending[dependent] -= 1
+                if not self.pending[dependent] and self.resolved[dependent]:
+                    ready.append(dependent)
+
+    def remaining(self):
+        """
+        Return ``{object: set(objects it depends on)}`` of the serialized
+        objects that weren't emitted, like ``ObjectGraph.dependencies``
+        """
+        self.read_edges()
+        graph = self.graph
+        depends_on = dict(
+            (graph.objects[node_id], set())
+            for node_id, included in enumerate(graph.included)
+            if included and not self.emitted[node_id])
+        for index, flags in enumerate(graph.flags):
+            source = graph.sources[index]
+            target = graph.targets[index]
+            if flags & WAITS and not graph.included[target]:
+                continue
+            if flags & (DEPENDS | WAITS) and not self.emitted[source] and not self.emitted[target]:
+                depends_on[graph.objects[source]].add(graph.objects[target])
+        return depends_on
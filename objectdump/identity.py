@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+"""
+Keep the instances a traversal loads, so a row reached again through a
+foreign key isn't queried again.
+"""
+from collections import OrderedDict
+
+
+class IdentityMap(object):
+    """
+    The last ``max_size`` instances added or looked up, by ``(model, pk)``.
+    The least recently used instance is dropped past ``max_size``.
+
+    ``hits`` and ``misses`` count the lookups that found an instance and the
+    ones that didn't.
+    """
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.objects = OrderedDict()  # {(model, pk): instance}
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.objects)
+
+    def add(self, obj):
+        key = (obj.__class__, obj.pk)
+        self.objects[key] = obj
+        self.objects.move_to_end(key)
+        if len(self.objects) > self.max_size:
+            self.objects.popitem(last=False)
+
+    def get(self, model, pk):
+        """
+        Return the instance of ``model`` with the primary key ``pk``, or
+        ``None``
+        """
+        obj = self.objects.get((model, pk))
+        if obj is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.objects.move_to_end((model, pk))
+        return obj
+
+    def cache_related(self, obj, field, model, pk):
+        """
+        Put the instance of ``model`` with the primary key ``pk`` in the
+        cache of the relation ``field`` of ``obj``, if there is one. Returns
+        whether there was.
+        """
+        rel_obj = self.get(model, pk)
+        if rel_obj is None:
+            return False
+        field.set_cached_value(obj, rel_obj)
+        return True
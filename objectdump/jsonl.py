@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+"""
+JSON Lines: one object per line, in the same layout as the json format.
+
+Django 3.2+ has it built in. For older versions add
+``SERIALIZATION_MODULES = {'jsonl': 'objectdump.jsonl'}`` so ``loaddata``
+can read it too.
+"""
+try:
+    from django.core.serializers.jsonl import Deserializer, Serializer  # NOQA
+except ImportError:
+    import json
+
+    from django.core.serializers.base import DeserializationError
+    from django.core.serializers.json import DjangoJSONEncoder
+    from django.core.serializers.python import Deserializer as PythonDeserializer
+    from django.core.serializers.python import Serializer as PythonSerializer
+
+    class Serializer(PythonSerializer):
+        """
+        Write each object on its own line as soon as it is serialized
+        """
+        internal_use_only = False
+
+        def _init_options(self):
+            self._current = None
+            self.json_kwargs = self.options.copy()
+            self.json_kwargs.pop("stream", None)
+            self.json_kwargs.pop("fields", None)
+            self.json_kwargs.pop("indent", None)
+            self.json_kwargs["separators"] = (",", ": ")
+            self.json_kwargs.setdefault("cls", DjangoJSONEncoder)
+            self.json_kwargs.setdefault("ensure_ascii", False)
+
+        def start_serialization(self):
+            self._init_options()
+
+        def end_object(self, obj):
+            json.dump(self.get_dump_object(obj), self.stream, **self.json_kwargs)
+            self.stream.write("\n")
+            self._current = None
+
+        def getvalue(self):
+            # Skip PythonSerializer.getvalue, which returns the objects.
+            return super(PythonSerializer, self).getvalue()
+
+    def Deserializer(stream_or_string, **options):
+        """
+        Deserialize JSON Lines one line at a time. A stream is read line by
+        line, so it is never held in memory as a whole.
+        """
+        if isinstance(stream_or_string, bytes):
+            stream_or_string = stream_or_string.decode()
+        if isinstance(stream_or_string, str):
+            stream_or_string = stream_or_string.split("\n")
+        for line in stream_or_string:
+            if isinstance(line, bytes):
+                line = line.decode()
+            if not line.strip():
+                continue
+            try:
+                for obj in PythonDeserializer([json.loads(line)], **options):
+                    yield obj
+            except (GeneratorExit, DeserializationError):
+                raise
+            except Exception as e:
+                raise DeserializationError(e)
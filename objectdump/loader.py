@@ -0,0 +1,253 @@
+# -*- coding: utf-8 -*-
+"""
+Read the fixtures ``object_dump`` writes and insert their objects in bulk.
+"""
+import json
+import os
+from collections import defaultdict
+from contextlib import contextmanager
+from itertools import groupby, islice
+
+from django.apps import apps
+from django.core.management.color import no_style
+from django.db import DEFAULT_DB_ALIAS, connections, router, transaction
+
+from .bulk import chunked
+from .output import COMPRESSORS, SUFFIXES
+from .serializer import get_deserializer
+from .shards import MANIFEST
+
+
+def get_fixture_format(path, format=None):
+    """
+    Return the ``(format, compression)`` of the fixture ``path``, from its
+    suffixes, e.g. ``('json', 'gzip')`` for ``dump.json.gz``. ``format``
+    overrides the format suffix.
+    """
+    base, extension = os.path.splitext(os.path.basename(path))
+    compression = SUFFIXES.get(extension.lower())
+    if compression is None:
+        base = os.path.basename(path)
+    return format or os.path.splitext(base)[1][1:], compression
+
+
+def iter_fixtures(paths, format=None):
+    """
+    Yield ``(path, format)`` of the fixtures in ``paths``. A directory of
+    shards yields its shards in the order they were written, which is the
+    dependency order of their objects.
+    """
+    for path in paths:
+        if not os.path.isdir(path):
+            yield path, format
+            continue
+        with open(os.path.join(path, MANIFEST)) as f:
+            manifest = json.load(f)
+        for shard in manifest['shards']:
+            yield os.path.join(path, shard['file']), format or manifest['format']
+
+
+def read_fixture(path, format=None, using=DEFAULT_DB_ALIAS):
+    """
+    Yield the ``DeserializedObject``s of the fixture ``path``
+    """
+    format, compression = get_fixture_format(path, format)
+    Deserializer = get_deserializer(format)
+    if compression is None:
+        fixture = open(path, encoding='utf-8')
+    else:
+        fixture = COMPRESSORS[compression](path, 'rt', encoding='utf-8')
+    with fixture:
+        for obj in Deserializer(fixture, using=using):
+            yield obj
+
+
+def delete_objects(deleted, using=DEFAULT_DB_ALIAS, batch_size=None):
+    """
+    Delete the objects of ``{model label: [pk, ...]}``, the ``deleted`` of a
+    ``--hash-manifest``, ``batch_size`` at a time. Returns the number of
+    rows deleted, with the cascades.
+    """
+    count = 0
+    for label, pks in deleted.items():
+        model = apps.get_model(label)
+        if not router.allow_migrate_model(using, model):
+            continue
+        to_python = model._meta.pk.to_python
+        for chunk in chunked([to_python(pk) for pk in pks], batch_size):
+            count += model._base_manager.using(using).filter(pk__in=chunk).delete()[0]
+    return count
+
+
+CONFLICTS = ('fail', 'skip', 'update')
+
+
+def can_bulk_create(model):
+    """
+    ``bulk_create`` can't insert the rows of multi-table inherited models
+    """
+    return all(parent._meta.concrete_model is model._meta.concrete_model
+               for parent in model._meta.get_parent_list())
+
+
+class BulkLoader(object):
+    """
+    Insert ``DeserializedObject``s with ``bulk_create``, ``batch_size``
+    consecutive objects of a model at a time, in the order they come in, and
+    their many-to-many rows with one ``bulk_create`` per through model.
+
+    An object that was already loaded, like the objects ``--breakcycles``
+    outputs again with their foreign keys, is updated with ``bulk_update``.
+    Multi-table inherited models and objects without a primary key are saved
+    one by one, like ``loaddata`` does. No signal is sent for bulk inserts
+    and updates.
+
+    ``conflict`` is what happens to rows whose primary key is already in the
+    database: ``fail`` raises an ``IntegrityError``, ``skip`` leaves them as
+    they are and ``update`` overwrites their fields and many-to-many rows.
+
+    A ``Remapper`` gives the objects new primary keys before they are
+    inserted, so they don't conflict.
+    """
+    def __init__(self, using=DEFAULT_DB_ALIAS, batch_size=None, conflict='fail', remapper=None):
+        self.using = using
+        self.batch_size = batch_size
+        self.conflict = conflict
+        self.remapper = remapper
+        self.models = set()
+        self.loaded = set()  # (concrete model, pk) of the objects loaded
+        self.skipped = set()  # (concrete model, pk) of the objects the conflict policy skipped
+        self.object_count = 0  # objects inserted, updated or saved
+        self.fixture_object_count = 0  # objects read
+
+    @contextmanager
+    def atomic(self):
+        """
+        Load in one transaction, with the constraints checked at the end,
+        then reset the sequences of the loaded models
+        """
+        connection = connections[self.using]
+        with transaction.atomic(using=self.using):
+            with connection.constraint_checks_disabled():
+                yield self
+            # The constraints weren't checked while loading.
+            connection.check_constraints(
+                table_names=[model._meta.db_table for model in self.models])
+            if self.object_count:
+                with connection.cursor() as cursor:
+                    for line in connection.ops.sequence_reset_sql(no_style(), self.models):
+                        cursor.execute(line)
+
+    def load(self, objects):
+        for model, group in groupby(objects, key=lambda obj: type(obj.object)):
+            for batch in iter(lambda: list(islice(group, self.batch_size)), []):
+                self.fixture_object_count += len(batch)
+                if router.allow_migrate_model(self.using, model):
+                    self.load_batch(model, batch)
+
+    def load_batch(self, model, batch):
+        self.models.add(model)
+        if self.remapper is not None:
+            self.remapper.rewrite(model, batch)
+        inserts = []
+        inserting = set()
+        updates = []
+        saves = []
+        for obj in batch:
+            pk = obj.object.pk
+            key = (model._meta.concrete_model, pk)
+            if pk is None or not can_bulk_create(model):
+                saves.append(obj)
+            elif key in self.skipped:
+                # Later records of a skipped object, like --breakcycles
+                # patches, don't touch the row either.
+                continue
+            elif key in self.loaded or key in inserting:
+                updates.append(obj)
+            else:
+                inserts.append(obj)
+                inserting.add(key)
+        if inserts:
+            inserted = self.insert(model, inserts)
+            self.loaded.update(inserted)
+            self.skipped.update(inserting - inserted)
+            self.object_count += len(inserted)
+            updates = [obj for obj in updates
+                       if (model._meta.concrete_model, obj.object.pk) not in self.skipped]
+        if updates:
+            self.update(model, updates)
+            self.object_count += len(updates)
+        for obj in saves:
+            obj.save(using=self.using)
+            self.loaded.add((model._meta.concrete_model, obj.object.pk))
+        self.object_count += len(saves)
+
+    def get_update_fields(self, model):
+        return [field.name for field in model._meta.concrete_model._meta.local_concrete_fields
+                if not field.primary_key]
+
+    def insert(self, model, objs):
+        """
+        Insert ``objs`` as the conflict policy says. Returns the ``(concrete
+        model, pk)`` of the objects whose rows now hold their fields.
+        """
+        manager = model._base_manager.using(self.using)
+        fields = self.get_update_fields(model)
+        if self.conflict == 'fail':
+            manager.bulk_create([obj.object for obj in objs], batch_size=self.batch_size)
+        elif (self.conflict == 'update' and fields
+              and connections[self.using].features.supports_update_conflicts_with_target):
+            manager.bulk_create(
+                [obj.object for obj in objs], batch_size=self.batch_size,
+                update_conflicts=True, unique_fields=[model._meta.pk.name],
+                update_fields=fields)
+        else:
+            existing = set(manager.filter(
+                pk__in=[obj.object.pk for obj in objs]).values_list('pk', flat=True))
+            if self.conflict == 'skip':
+                # Skipped rows keep their many-to-many rows too.
+                objs = [obj for obj in objs if obj.object.pk not in existing]
+            elif fields:
+                manager.bulk_update(
+                    [obj.object for obj in objs if obj.object.pk in existing], fields,
+                    batch_size=self.batch_size)
+            manager.bulk_create(
+                [obj.object for obj in objs if obj.object.pk not in existing],
+                batch_size=self.batch_size)
+        self.insert_many2many(model, objs)
+        return set((model._meta.concrete_model, obj.object.pk) for obj in objs)
+
+    def update(self, model, objs):
+        fields = self.get_update_fields(model)
+        if fields:
+            model._base_manager.using(self.using).bulk_update(
+                [obj.object for obj in objs], fields, batch_size=self.batch_size)
+
+    def insert_many2many(self, model, objs):
+        """
+        Insert the through rows of the many-to-many fields of ``objs``. With
+        the ``update`` conflict policy, their existing rows are replaced.
+        """
+        rows = defaultdict(list)  # {through model: [through instances]}
+        replaced = defaultdict(set)  # {(through model, source attname): source values}
+        for obj in objs:
+            for name, values in (obj.m2m_data or {}).items():
+                field = model._meta.get_field(name)
+                through = field.remote_field.through
+                if not through._meta.auto_created:
+                    getattr(obj.object, name).set(values)
+                    continue
+                source = through._meta.get_field(field.m2m_field_name())
+                target = through._meta.get_field(field.m2m_reverse_field_name())
+                value = getattr(obj.object, source.target_field.attname)
+                replaced[(through, source.attname)].add(value)
+                rows[through].extend(
+                    through(**{source.attname: value, target.attname: related})
+                    for related in values)
+        if self.conflict == 'update':
+            for (through, attname), values in replaced.items():
+                through._base_manager.using(self.using).filter(**{
+                    '%s__in' % attname: list(values)}).delete()
+        for through, through_objs in rows.items():
+            through._base_manager.using(self.using).bulk_create(
+                through_objs, batch_size=self.batch_size)
@@ -1,21 +1,35 @@
+import copy
 import pprint
-from collections import Iterable, defaultdict
-from itertools import chain
-
+from collections import defaultdict
+from collections.abc import Iterable
+from itertools import groupby, islice
 from django.apps import apps
-from django.core.exceptions import FieldError, ObjectDoesNotExist
+from django.core.serializers.base import DeserializedObject
+from django.core.exceptions import FieldDoesNotExist, FieldError, ObjectDoesNotExist
 from django.core.management.base import BaseCommand, CommandError
 from django.db import DEFAULT_DB_ALIAS, models
-from django.db.models import ForeignKey
 from django.template import Variable
 
 # If importing MODEL_SETTINGS directly, the tests can't update the settings between tests.
 from ... import settings
+from ...bulk import (bulk_load_foreignkeys, bulk_load_genericforeignkeys,
+                     bulk_load_many2many, bulk_load_reverse, chunked,
+                     fetch_many2many_keys, fetch_pks, fetch_reverse_keys,
+                     fetch_rows, prefetch_attr, warm_content_types)
+from ...cycles import (break_cycles, describe_cycles, find_cycles,
+                       get_dependency_edges)
+from ...delta import DeltaFilter, read_manifest, write_manifest
 from ...diagram import make_dot
-from ...models import (ObjectFilter, get_key, get_many_to_many,
-                       get_reverse_relations)
-from ...serializer import get_serializer
-from ...topological_sort import toposort
+from ...fastjson import get_fast_serializer
+from ...graph import DEPENDS, GENERATES, LABELLED, WAITS, ObjectGraph, OnlineOrder
+from ...identity import IdentityMap
+from ...loader import CONFLICTS, BulkLoader
+from ...models import ObjectFilter, ObjectKey
+from ...output import COMPRESSORS, open_output
+from ...plan import compile_plan, get_model_dependencies
+from ...serializer import BufferedStream, get_serializer
+from ...shards import Layers, ShardWriter
+from ...topological_sort import get_model_key, toposort
 
 
 def get_fields():
@@ -31,19 +45,15 @@ def get_fields():
             excluded_fields[key] = settings.MODEL_SETTINGS[key]["exclude"]
     return fields, excluded_fields
 
-def get_all_field_names(obj):
-    return list(set(chain.from_iterable(
-        (field.name, field.attname) if hasattr(field, 'attname') else (field.name,)
-        for field in obj._meta.get_fields()
-        # For complete backwards compatibility, you may want to exclude
-        # GenericForeignKey from the results.
-        if not (field.many_to_one and field.related_model is None)
-    )))
 
 class Command(BaseCommand):
     help = ("Output the contents of one or more objects and their related "
             "items as a fixture of the given format.")
     args = "app_name.model_name [id1 [id2 [...]]]"
+    defer_fields = False
+    order = 'object'
+    record_edges = True
+    identity_map_size = None  # IDENTITY_MAP_SIZE if None
 
     def add_arguments(self, parser):
         parser.add_argument("model", nargs="+")
@@ -143,14 +153,240 @@ class Command(BaseCommand):
             default=False,
             help="Raise exception if there are cyclic FK references in the DB entities. Usually this is not an issue because 'loaddata' management command temporarily disables FK constraints.",
         )
+        parser.add_argument(
+            "--breakcycles",
+            action="store_true",
+            dest="breakcycles",
+            default=False,
+            help="Break cyclic dependencies through nullable foreign keys: the objects are output with the "
+            "foreign key set to null, and again with its value after all the other objects.",
+        )
+        parser.add_argument(
+            "--order",
+            dest="order",
+            default="object",
+            choices=["object", "model", "online"],
+            help="Order the objects so each object comes after the objects it depends on (object), "
+            "group them by model, each model after the models it depends on (model), "
+            "or output each object as soon as the objects it depends on are output, "
+            "while traversing (online).",
+        )
+        parser.add_argument(
+            "--batch",
+            action="store_true",
+            dest="batch",
+            default=False,
+            help="Traverse related objects level by level, fetching each relation with one query per model instead of one query per object.",
+        )
+        parser.add_argument(
+            "--keys-only",
+            action="store_true",
+            dest="keys_only",
+            default=False,
+            help="Traverse related objects level by level using only primary keys and relation columns, then fetch the full objects in chunks while serializing. Uses less memory than --batch.",
+        )
+        parser.add_argument(
+            "--output",
+            "-o",
+            dest="output",
+            default=None,
+            help="Write the output to this file instead of stdout. It is compressed if its suffix is .gz, .bz2, .xz or .lzma.",
+        )
+        parser.add_argument(
+            "--compress",
+            dest="compress",
+            default=None,
+            choices=sorted(COMPRESSORS),
+            help="Compress the --output file with gzip, bz2 or lzma, whatever its suffix.",
+        )
+        parser.add_argument(
+            "--compresslevel",
+            dest="compresslevel",
+            default=None,
+            type=int,
+            help="The compression level, 1 (fastest) to 9 (smallest), 0 to 9 for lzma. Defaults to the compressor's default.",
+        )
+        parser.add_argument(
+            "--buffer-size",
+            dest="buffer_size",
+            default=None,
+            type=int,
+            help="The number of characters of output collected before writing them out. Defaults to the BUFFER_SIZE setting.",
+        )
+        parser.add_argument(
+            "--shard-dir",
+            dest="shard_dir",
+            default=None,
+            help="Write the output to a directory of fixture shards, split by dependency layer and model, with a manifest.json of their load order.",
+        )
+        parser.add_argument(
+            "--shard-objects",
+            dest="shard_objects",
+            default=None,
+            type=int,
+            help="The maximum number of objects in a shard.",
+        )
+        parser.add_argument(
+            "--shard-size",
+            dest="shard_size",
+            default=None,
+            type=int,
+            help="The approximate maximum number of characters of output in a shard, before compression.",
+        )
+        parser.add_argument(
+            "--copy-to",
+            dest="copy_to",
+            default=None,
+            help="Copy the objects straight to this database, in bulk and in one transaction, instead of serializing them.",
+        )
+        parser.add_argument(
+            "--conflict",
+            dest="conflict",
+            default="fail",
+            choices=CONFLICTS,
+            help="What --copy-to does with objects whose primary key is already in the target database: "
+            "fail, skip them or update the rows. Defaults to fail.",
+        )
+        parser.add_argument(
+            "--hash-manifest",
+            dest="hash_manifest",
+            default=None,
+            help="Write the content hash of each object dumped to this file, for a later --since-manifest.",
+        )
+        parser.add_argument(
+            "--since-manifest",
+            dest="since_manifest",
+            default=None,
+            help="Only dump the objects that are new or changed since this --hash-manifest, "
+            "and list the ones no longer dumped as deleted in the new --hash-manifest.",
+        )
+        parser.add_argument(
+            "--identity-map-size",
+            dest="identity_map_size",
+            default=None,
+            type=int,
+            help="The number of objects kept to be reused when a foreign key points at them again, "
+            "0 to keep none. Defaults to the IDENTITY_MAP_SIZE setting.",
+        )
 
-    def process_additional_relations(self, obj, limit=None):
-        key = ".".join([obj._meta.app_label, obj._meta.model_name])
-        addl_relations = settings.MODEL_SETTINGS.get(key, {}).get('addl_relations', [])
-        output = []
-        obj_key = get_key(obj, include_pk=self.use_obj_key)
-        add_dependency = False
-        for rel in addl_relations:
+    def get_model_plan(self, model):
+        """
+        Return the ``TraversalPlan`` for ``model``, compiled on first use
+        """
+        try:
+            return self.plans[model]
+        except KeyError:
+            plan = self.plans[model] = compile_plan(model, self.obj_filter)
+            return plan
+
+    def get_plan(self, obj):
+        return self.get_model_plan(obj._meta.model)
+
+    def get_traversal_fields(self, model):
+        """
+        Return the field names to load for ``model`` objects found while
+        traversing, or ``None`` for all of them
+        """
+        if not self.defer_fields:
+            return None
+        return self.get_model_plan(model).traversal_fields
+
+    def prune_relations(self, models):
+        """
+        Compile the plans of all the models reachable from ``models`` through
+        the schema before the traversal starts.
+
+        Relations to models the filter always skips are left out of the
+        plans, so they are never queried. They are reported in verbose mode.
+        """
+        seen = set()
+        todo = list(models)
+        while todo:
+            model = todo.pop()
+            if model in seen:
+                continue
+            seen.add(model)
+            plan = self.get_model_plan(model)
+            if self.verbose:
+                for name, target in plan.pruned:
+                    pprint.pprint("Pruned %s.%s -> %s" % (plan.key, name, target._meta.label_lower),
+                                  stream=self.stderr)
+            todo.extend(rel.related_model for rel in plan.reverse_fields)
+            todo.extend(field.related_model for field in plan.m2m_fields)
+            todo.extend(field.related_model for field in plan.foreign_keys)
+
+    def get_obj_key(self, obj):
+        """
+        Same as ``get_key(obj, include_pk=self.use_obj_key)``, using the
+        plan's model key
+        """
+        if self.use_obj_key:
+            return "%s.%s" % (self.get_plan(obj).key, obj.pk)
+        return self.get_plan(obj).key
+
+    def add_relation(self, obj, obj_key, name, rel_obj, dependency=True):
+        """
+        Record that ``obj`` generates ``rel_obj`` through the relation
+        ``name``, and, if ``dependency``, that it depends on ``rel_obj``
+        """
+        if self.record_edges:
+            flags = GENERATES | LABELLED | DEPENDS if dependency else GENERATES
+            self.graph.add_edge(obj, rel_obj, name, flags)
+        if dependency and self.order == 'model':
+            self.add_model_dependency(obj, rel_obj)
+        if self.verbose:
+            pprint.pprint("%s.%s -> %s" % (obj_key, name, self.get_obj_key(rel_obj)),
+                          stream=self.stderr)
+
+    def add_model_dependency(self, obj, rel_obj):
+        """
+        Record that the model of ``obj`` depends on the model of ``rel_obj``,
+        for relations the schema doesn't show, like generic foreign keys
+        """
+        self.graph.include(obj)
+        self.graph.include(rel_obj)
+        self.model_dependencies[obj._meta.concrete_model].add(rel_obj._meta.concrete_model)
+
+    def order_by_model(self, allow_cycles=False):
+        """
+        Return the objects to serialize grouped by model, each model after the
+        models it depends on, and each group in primary key order.
+
+        The models are sorted from the schema and the dependencies recorded
+        while traversing, without an object-level dependency graph.
+        """
+        by_model = defaultdict(list)
+        for obj in self.graph.included_objects():
+            by_model[obj._meta.concrete_model].append(obj)
+        dependencies = dict(
+            (model, (get_model_dependencies(model) | self.model_dependencies[model])
+             & set(by_model) - {model})
+            for model in by_model)
+        self.ordered_model_dependencies = dependencies
+        return (obj for model in toposort(dependencies, allow_cycles, key=get_model_key)
+                for obj in sorted(by_model[model], key=lambda obj: obj.pk))
+
+    def get_layers(self, cut=()):
+        """
+        Return the ``Layers`` of the serialized objects, from the dependencies
+        of the objects, leaving out the edges in ``cut``, or of the models with
+        ``--order model``
+        """
+        if self.order == 'model':
+            return Layers(self.ordered_model_dependencies,
+                          lambda obj: obj._meta.concrete_model)
+        edges = get_dependency_edges(self.graph, cut)
+        dependencies = dict(
+            (node, [target for target, index in targets]) for node, targets in edges.items())
+        return Layers(dependencies,
+                      lambda obj: self.graph.ids[(obj._meta.concrete_model, obj.pk)])
+
+    def get_additional_relations(self, obj):
+        """
+        Yield ``(rel, rel_obj, add_dependency)`` for the configured
+        additional relations of ``obj``
+        """
+        for rel in self.get_plan(obj).addl_relations:
             if callable(rel):
                 rel_objs = rel(obj)
                 add_dependency = getattr(rel, 'depends_on_obj', False)
@@ -162,38 +398,49 @@ class Command(BaseCommand):
             if not isinstance(rel_objs, Iterable):
                 rel_objs = [rel_objs]
             for rel_obj in rel_objs:
-                rel_key = get_key(rel_obj, include_pk=self.use_obj_key)
-                if add_dependency:
-                    self.depends_on[rel_obj].add(obj)
-                    self.relationships[obj_key][rel.__name__].add(rel_key)
-                self.generates[obj_key].add(rel_key)
-                if self.verbose:
-                    pprint.pprint("%s.%s -> %s" % (obj_key, rel, rel_key),
-                        stream=self.stderr)
-                output.append(rel_obj)
+                yield rel, rel_obj, add_dependency
+
+    def process_additional_relations(self, obj, limit=None, node=None):
+        """
+        ``node`` is recorded in the dependencies instead of ``obj`` if given,
+        and the related objects are turned into ``ObjectKey``s.
+        """
+        output = []
+        node = obj if node is None else node
+        obj_key = self.get_obj_key(node)
+        for rel, rel_obj, add_dependency in self.get_additional_relations(obj):
+            if node is not obj:
+                rel_obj = ObjectKey.for_model(rel_obj.__class__, rel_obj.pk)
+            if self.record_edges and add_dependency:
+                self.graph.add_edge(rel_obj, node, flags=DEPENDS)
+                self.graph.add_edge(node, rel_obj, rel.__name__, GENERATES | LABELLED)
+            elif self.record_edges:
+                self.graph.add_edge(node, rel_obj)
+            if add_dependency and self.order == 'model':
+                self.add_model_dependency(rel_obj, node)
+            if self.verbose:
+                pprint.pprint("%s.%s -> %s" % (obj_key, rel, self.get_obj_key(rel_obj)),
+                    stream=self.stderr)
+            output.append(rel_obj)
         return output
 
     def process_related_fields(self, obj, limit=None, obj_filter=None):
-        related_fields = get_reverse_relations(obj)
         output = []
-        obj_key = get_key(obj, include_pk=self.use_obj_key)
-        key = ".".join([obj._meta.app_label, obj._meta.model_name])
-        m2m_fields = settings.MODEL_SETTINGS.get(key, {}).get('reverse_relations', related_fields)
-        # m2m_fields could be True for all, False for none, or an iterable for
-        # some of the m2m_fields
-        if m2m_fields is True:
-            m2m_fields = related_fields
-        elif m2m_fields is False:
-            m2m_fields = []
-        for rel in m2m_fields:
+        obj_key = self.get_obj_key(obj)
+        for rel in self.get_plan(obj).reverse_relations:
             try:
-                related_objs = obj.__getattribute__(rel)
+                # Use the objects loaded by bulk_load_reverse, if any.
+                if hasattr(obj, prefetch_attr(rel)):
+                    related_objs = getattr(obj, prefetch_attr(rel))
+                else:
+                    related_objs = obj.__getattribute__(rel)
                 if related_objs is None:
                     raise ObjectDoesNotExist()
                 # handle OneToOneField case for related object
                 if isinstance(related_objs, models.Model):
                     related_objs = [related_objs]
-                else:  # everything else uses a related manager
+                elif not isinstance(related_objs, list):
+                    # everything else uses a related manager
                     related_objs = related_objs.all()
 
                 if limit:
@@ -201,11 +448,7 @@ class Command(BaseCommand):
                 for rel_obj in related_objs:
                     if obj_filter is not None and obj_filter.skip(rel_obj):
                         continue
-                    rel_key = get_key(rel_obj, include_pk=self.use_obj_key)
-                    self.generates[obj_key].add(rel_key)
-                    if self.verbose:
-                        pprint.pprint("%s.%s -> %s" % (obj_key, rel, rel_key),
-                                      stream=self.stderr)
+                    self.add_relation(obj, obj_key, rel, rel_obj, dependency=False)
                     output.append(rel_obj)
             except (FieldError, ObjectDoesNotExist):
                 pass
@@ -213,34 +456,25 @@ class Command(BaseCommand):
 
     def process_many2many(self, obj, limit=None, obj_filter=None):
         output = []
-        obj_key = get_key(obj, include_pk=self.use_obj_key)
-        key = ".".join([obj._meta.app_label, obj._meta.model_name])
-        related_fields = get_many_to_many(obj)
-        m2m_fields = settings.MODEL_SETTINGS.get(key, {}).get('m2m_fields', related_fields)
-
-        # m2m_fields could be True for all, False for none, or an iterable for
-        # some of the m2m_fields
-        if m2m_fields is True:
-            m2m_fields = related_fields
-        elif m2m_fields is False:
-            m2m_fields = []
-        for rel in m2m_fields:
+        obj_key = self.get_obj_key(obj)
+        for rel in self.get_plan(obj).m2m_relations:
             try:
-                related_objs = obj.__getattribute__(rel)
-                related_objs = related_objs.all()
+                # Use the objects loaded by bulk_load_many2many, if any.
+                if hasattr(obj, prefetch_attr(rel)):
+                    related_objs = getattr(obj, prefetch_attr(rel))
+                else:
+                    related_objs = obj.__getattribute__(rel).all()
 
                 if limit:
+                    if self.order == 'online':
+                        # The keys of all the related objects are serialized.
+                        for rel_obj in related_objs[limit:]:
+                            self.graph.add_edge(obj, rel_obj, flags=WAITS)
                     related_objs = related_objs[:limit]
                 for rel_obj in related_objs:
                     if obj_filter is not None and obj_filter.skip(rel_obj):
                         continue
-                    rel_key = get_key(rel_obj, include_pk=self.use_obj_key)
-                    self.depends_on[obj].add(rel_obj)
-                    self.relationships[obj_key][rel].add(rel_key)
-                    self.generates[obj_key].add(rel_key)
-                    if self.verbose:
-                        pprint.pprint("%s.%s -> %s" % (obj_key, rel, rel_key),
-                                      stream=self.stderr)
+                    self.add_relation(obj, obj_key, rel, rel_obj)
                     output.append(rel_obj)
             except (FieldError, ObjectDoesNotExist):
                 pass
@@ -248,96 +482,260 @@ class Command(BaseCommand):
 
     def process_foreignkeys(self, obj, obj_filter=None):
         output = []
-        obj_key = get_key(obj, include_pk=self.use_obj_key)
-        key = ".".join([obj._meta.app_label, obj._meta.model_name])
-        all_field_names = get_all_field_names(obj)
-        fk_fields = settings.MODEL_SETTINGS.get(key, {}).get('fk_fields', all_field_names)
-        # fk_fields could be True for all, False for none, or an iterable for
-        # some of the m2m_fields
-        if fk_fields is True:
-            fk_fields = all_field_names
-        elif fk_fields is False:
-            fk_fields = []
-        for field in obj._meta.fields:
-            if isinstance(field, ForeignKey) and field.name in fk_fields:
-                try:
-                    fk_obj = obj.__getattribute__(field.name)
-                    if fk_obj and obj_filter is not None and not obj_filter.skip(fk_obj):
-                        fk_key = get_key(fk_obj, include_pk=self.use_obj_key)
-                        self.depends_on[obj].add(fk_obj)
-                        self.relationships[obj_key][field.name].add(fk_key)
-                        self.generates[obj_key].add(fk_key)
-                        if self.verbose:
-                            pprint.pprint("%s.%s -> %s" % (obj_key, field.name, fk_key),
-                                          stream=self.stderr)
-                        output.append(fk_obj)
-                except TypeError as e:
-                    print("Error processing FK:", e, obj, field.name)
+        obj_key = self.get_obj_key(obj)
+        for field in self.get_plan(obj).foreign_keys:
+            # Don't load the related object just to find out it is missing.
+            value = getattr(obj, field.attname)
+            if value is None:
+                continue
+            cached = field.is_cached(obj) or (
+                self.identity_map is not None and field.target_field.primary_key
+                and self.identity_map.cache_related(obj, field, field.related_model, value))
+            try:
+                fk_obj = obj.__getattribute__(field.name)
+                if fk_obj and not cached and self.identity_map is not None:
+                    self.identity_map.add(fk_obj)
+                if fk_obj and obj_filter is not None and not obj_filter.skip(fk_obj):
+                    self.add_relation(obj, obj_key, field.name, fk_obj)
+                    output.append(fk_obj)
+            except TypeError as e:
+                print("Error processing FK:", e, obj, field.name)
         return output
 
     def process_genericforeignkeys(self, obj, obj_filter=None):
         output = []
-        obj_key = get_key(obj, include_pk=self.use_obj_key)
-        key = ".".join([obj._meta.app_label, obj._meta.model_name])
-        all_field_names = [x.name for x in obj._meta.private_fields]
-        gfk_fields = settings.MODEL_SETTINGS.get(key, {}).get("gfk_fields", all_field_names)
-        if gfk_fields is True:
-            gfk_fields = all_field_names
-        elif gfk_fields is False:
-            gfk_fields = []
-        for field in obj._meta.private_fields:
-            if field.name in gfk_fields:
-                try:
-                    gfk_obj = obj.__getattribute__(field.name)
-                    if (
-                        gfk_obj
-                        and obj_filter is not None
-                        and not obj_filter.skip(gfk_obj)
-                    ):
-                        gfk_key = get_key(gfk_obj, include_pk=self.use_obj_key)
-                        self.depends_on[obj].add(gfk_obj)
-                        self.relationships[obj_key][field.name].add(gfk_key)
-                        self.generates[obj_key].add(gfk_key)
-                        if self.verbose:
-                            pprint.pprint(
-                                "%s.%s -> %s" % (obj_key, field.name, gfk_key),
-                                stream=self.stderr,
-                            )
-                        output.append(gfk_obj)
-                except TypeError:
-                    print("Error getting GFK %s" % field.name)
+        obj_key = self.get_obj_key(obj)
+        for field in self.get_plan(obj).generic_foreign_keys:
+            cached = field.is_cached(obj) or self.cache_generic(obj, field)
+            try:
+                gfk_obj = obj.__getattribute__(field.name)
+                if gfk_obj and not cached and self.identity_map is not None:
+                    self.identity_map.add(gfk_obj)
+                if (
+                    gfk_obj
+                    and obj_filter is not None
+                    and not obj_filter.skip(gfk_obj)
+                ):
+                    self.add_relation(obj, obj_key, field.name, gfk_obj)
+                    output.append(gfk_obj)
+            except TypeError:
+                print("Error getting GFK %s" % field.name)
         return output
 
+    def cache_generic(self, obj, field):
+        """
+        Put the target of the generic foreign key ``field`` of ``obj`` in its
+        cache from the identity map, if it is there. Returns whether it was.
+        """
+        if self.identity_map is None:
+            return False
+        ct_id = getattr(obj, obj._meta.get_field(field.ct_field).attname)
+        value = getattr(obj, field.fk_field)
+        if ct_id is None or value is None:
+            return False
+        warm_content_types([ct_id], self.content_types, obj._state.db)
+        model = self.content_types.get(ct_id)
+        if model is None:  # stale content type
+            return False
+        return self.identity_map.cache_related(
+            obj, field, model, model._meta.pk.to_python(value))
+
     def process_object(self, obj, obj_filter=None):
         # Abort cyclic references.
         if obj._meta.proxy:
             obj = obj._meta.proxy_for_model.objects.get(pk=obj.pk)
 
-        if obj in self.priors:
+        if not self.graph.visit(obj):
             return
-        self.priors.add(obj)
 
         if obj_filter is not None and obj_filter.skip(obj):
             return
 
-        obj_key = get_key(obj, include_pk=self.use_obj_key)
-        self.to_serialize.append(obj)
-        if obj not in self.depends_on:
-            self.depends_on[obj] = set()
+        obj_key = self.get_obj_key(obj)
+        self.graph.add_object(obj)
+        if self.identity_map is not None and isinstance(obj, models.Model):
+            self.identity_map.add(obj)
         return obj_key
 
+    def process_relations(self, obj, depth, obj_filter=None, limit=None, max_depth=None):
+        """
+        Return the objects related to ``obj``, in the order they are queued
+        """
+        output = []
+        if max_depth is None or depth <= max_depth:
+            output.extend(self.process_related_fields(obj, limit, obj_filter))
+            output.extend(self.process_many2many(obj, limit, obj_filter))
+        output.extend(self.process_additional_relations(obj))
+        output.extend(self.process_foreignkeys(obj, obj_filter))
+        output.extend(self.process_genericforeignkeys(obj, obj_filter))
+        return output
+
+    def prefetch_level(self, objs, depth, limit=None, max_depth=None):
+        """
+        Fetch the relations of a whole level of objects at once.
+
+        The objects are grouped by model and each relation is loaded with one
+        query for the group. Foreign keys are grouped by target model instead,
+        so a row pointed at from several models or fields is loaded once.
+        Generic foreign keys are grouped by content type. Reverse relations
+        honour ``limit`` per parent. Many-to-many through tables are read
+        once, and the primary keys are kept in ``self.m2m_pks`` for the
+        serializer. The results land in the instances' caches, so the
+        ``process_*`` methods don't query the database again.
+        """
+        by_model = defaultdict(list)
+        for obj in objs:
+            by_model[obj.__class__].append(obj)
+        follow_reverse = max_depth is None or depth <= max_depth
+        fk_pairs = []
+        gfk_pairs = []
+        for instances in by_model.values():
+            plan = self.get_plan(instances[0])
+            if follow_reverse:
+                for rel in plan.reverse_fields:
+                    bulk_load_reverse(instances, rel, limit, settings.CHUNK_SIZE,
+                                      self.get_traversal_fields)
+            traversed = plan.m2m_fields if follow_reverse else ()
+            serialized = tuple(
+                field for field in plan.serialized_m2m_fields
+                if field not in traversed)
+            for field in traversed + serialized:
+                bulk_load_many2many(
+                    instances, field, self.m2m_pks, field in traversed,
+                    settings.CHUNK_SIZE, self.get_traversal_fields)
+            fk_pairs.extend(
+                (obj, field) for obj in instances for field in plan.foreign_keys)
+            gfk_pairs.extend(
+                (obj, field) for obj in instances
+                for field in plan.generic_foreign_keys)
+        bulk_load_foreignkeys(fk_pairs, self.get_traversal_fields, self.identity_map)
+        bulk_load_genericforeignkeys(
+            gfk_pairs, self.content_types, self.get_traversal_fields, self.identity_map)
+
+    def process_model_keys(self, model, keys, depth, obj_filter=None, limit=None,
+                           max_depth=None, using=None):
+        """
+        Return the ``ObjectKey``s related to ``keys``, which are all of
+        ``model``, in the order they are queued.
+
+        The relations are found from the primary keys and relation columns
+        fetched with ``values_list``. Each relation is one query for all the
+        ``keys``. Only models with additional relations are loaded as
+        instances, to call them.
+        """
+        plan = self.get_model_plan(model)
+        chunk_size = settings.CHUNK_SIZE
+        follow_reverse = max_depth is None or depth <= max_depth
+        reverse_fields = plan.reverse_fields if follow_reverse else ()
+        m2m_fields = plan.m2m_fields if follow_reverse else ()
+        m2m_sources = dict(
+            (field, field.remote_field.through._meta.get_field(field.m2m_field_name()))
+            for field in m2m_fields)
+        ct_attnames = dict(
+            (field, model._meta.get_field(field.ct_field).attname)
+            for field in plan.generic_foreign_keys)
+
+        columns = [field.attname for field in plan.foreign_keys]
+        for field in plan.generic_foreign_keys:
+            columns.extend([ct_attnames[field], field.fk_field])
+        columns.extend(rel.field.target_field.attname for rel in reverse_fields)
+        columns.extend(source.target_field.attname for source in m2m_sources.values())
+        columns = list(dict.fromkeys(columns))
+        rows = fetch_rows(model, [key.pk for key in keys], columns, using, chunk_size)
+        keys = [key for key in keys if key.pk in rows]
+
+        def column_values(attname):
+            return list(set(
+                rows[key.pk][attname] for key in keys
+                if rows[key.pk][attname] is not None))
+
+        reverse = {}
+        for rel in reverse_fields:
+            reverse[rel] = fetch_reverse_keys(
+                rel, column_values(rel.field.target_field.attname), limit, using, chunk_size)
+        m2m = {}
+        m2m_targets = {}
+        for field, source in m2m_sources.items():
+            m2m[field] = fetch_many2many_keys(
+                field, column_values(source.target_field.attname), using, chunk_size)
+            target = field.remote_field.through._meta.get_field(field.m2m_reverse_field_name())
+            m2m_targets[field] = fetch_pks(
+                field.related_model, target.target_field.attname,
+                list(set(value for values in m2m[field].values() for value in values)),
+                using, chunk_size)
+        fk_targets = {}
+        for field in plan.foreign_keys:
+            fk_targets[field] = fetch_pks(
+                field.related_model, field.target_field.attname,
+                column_values(field.attname), using, chunk_size)
+        for field in plan.generic_foreign_keys:
+            warm_content_types(column_values(ct_attnames[field]), self.content_types, using)
+        instances = {}
+        if plan.addl_relations:
+            instances = model._base_manager.using(using).in_bulk([key.pk for key in keys])
+
+        def add(key, obj_key, name, rel_model, pk, dependency=True):
+            rel_key = ObjectKey.for_model(rel_model, pk)
+            if obj_filter is not None and obj_filter.skip(rel_key):
+                return
+            self.add_relation(key, obj_key, name, rel_key, dependency)
+            output.append(rel_key)
+
+        output = []
+        for key in keys:
+            row = rows[key.pk]
+            obj_key = self.get_obj_key(key)
+            for rel in reverse_fields:
+                for pk in reverse[rel].get(row[rel.field.target_field.attname], []):
+                    add(key, obj_key, rel.get_accessor_name(), rel.related_model, pk, False)
+            for field, source in m2m_sources.items():
+                values = m2m[field].get(row[source.target_field.attname], [])
+                if limit:
+                    values = values[:limit]
+                for value in values:
+                    if value in m2m_targets[field]:
+                        add(key, obj_key, field.name, field.related_model, m2m_targets[field][value])
+            if key.pk in instances:
+                output.extend(self.process_additional_relations(instances[key.pk], node=key))
+            for field in plan.foreign_keys:
+                value = row[field.attname]
+                if value is not None and value in fk_targets[field]:
+                    add(key, obj_key, field.name, field.related_model, fk_targets[field][value])
+            for field in plan.generic_foreign_keys:
+                target = self.content_types.get(row[ct_attnames[field]])
+                value = row[field.fk_field]
+                if target is not None and value is not None:
+                    add(key, obj_key, field.name, target, target._meta.pk.to_python(value))
+        return output
+
+    def start_traversal(self, obj_filter=None):
+        self.graph = ObjectGraph()
+        self.model_dependencies = defaultdict(set)  # {model: set(models)}, beyond the schema
+        self.m2m_pks = {}  # {m2m field: {obj pk: [related pks]}}
+        self.content_types = {}  # {content type id: model}
+        self.plans = {}  # {model: TraversalPlan}
+        self.obj_filter = obj_filter
+        size = self.identity_map_size
+        if size is None:
+            size = settings.IDENTITY_MAP_SIZE
+        self.identity_map = IdentityMap(size) if size > 0 else None
+
     def process_queue(self, objs, obj_filter=None, limit=None, max_depth=None):
         """
         Generate a list of objects to serialize
         """
-        self.depends_on = defaultdict(set)  # {key: set(keys being pointed to)}
-        self.relationships = defaultdict(lambda: defaultdict(set))  # {key: {'field': set(objs)}}
-        self.generates = defaultdict(set)
-        self.to_serialize = []
+        self.start_traversal(obj_filter)
+        for obj in self.iter_queue(objs, obj_filter, limit, max_depth):
+            pass
 
+    def iter_queue(self, objs, obj_filter=None, limit=None, max_depth=None):
+        """
+        Traverse the objects breadth first, yielding each object once its
+        relations have been recorded
+        """
         # Recursively serialize all related objects.
-        self.priors = set()
         _queue = list(objs)
+        self.prune_relations(set(obj.__class__ for obj in _queue))
 
         self.queue = list(zip(_queue, [0] * len(_queue)))  # queue is obj, depth
         while self.queue:
@@ -346,22 +744,211 @@ class Command(BaseCommand):
             if obj_key is None:
                 continue
 
-            if max_depth is None or depth <= max_depth:
-                rel_objs = self.process_related_fields(obj, limit, obj_filter)
-                for rel in rel_objs:
-                    self.queue.append((rel, depth + 1))
-                rel_objs = self.process_many2many(obj, limit, obj_filter)
-                for rel in rel_objs:
-                    self.queue.append((rel, depth + 1))
-            addl_rel_objs = self.process_additional_relations(obj)
-            for ar_obj in addl_rel_objs:
-                self.queue.append((ar_obj, depth + 1))
-            fk_objs = self.process_foreignkeys(obj, obj_filter)
-            for fk_obj in fk_objs:
-                self.queue.append((fk_obj, depth + 1))
-            gfk_objs = self.process_genericforeignkeys(obj, obj_filter)
-            for gfk_obj in gfk_objs:
-                self.queue.append((gfk_obj, depth + 1))
+            for rel in self.process_relations(obj, depth, obj_filter, limit, max_depth):
+                self.queue.append((rel, depth + 1))
+            yield obj
+
+    def process_levels(self, objs, obj_filter=None, limit=None, max_depth=None):
+        """
+        Generate a list of objects to serialize, one depth level at a time.
+
+        Produces the same objects and dependencies as ``process_queue``, but
+        the relations of all the objects at a depth are fetched together.
+        """
+        self.start_traversal(obj_filter)
+        for obj in self.iter_levels(objs, obj_filter, limit, max_depth):
+            pass
+
+    def iter_levels(self, objs, obj_filter=None, limit=None, max_depth=None):
+        """
+        Traverse the objects one depth level at a time, yielding each object
+        once its relations have been recorded
+        """
+        level = list(objs)
+        self.prune_relations(set(obj.__class__ for obj in level))
+        depth = 0
+        while level:
+            level = [obj for obj in level
+                     if self.process_object(obj, obj_filter) is not None]
+            self.prefetch_level(level, depth, limit, max_depth)
+            next_level = []
+            for obj in level:
+                next_level.extend(
+                    self.process_relations(obj, depth, obj_filter, limit, max_depth))
+                yield obj
+            level = next_level
+            depth += 1
+
+    def process_online(self, objs, obj_filter=None, limit=None, max_depth=None,
+                       batch=False, allow_cycles=True):
+        """
+        Return an iterator of the objects to serialize that traverses as it
+        goes. Each object is yielded as soon as its relations have been
+        followed and the objects it depends on have been yielded.
+
+        The objects left waiting, in or after cycles, are yielded at the end
+        in ``toposort`` order.
+        """
+        self.start_traversal(obj_filter)
+        order = OnlineOrder(self.graph)
+        traverse = self.iter_levels if batch else self.iter_queue
+
+        def emit():
+            for obj in traverse(objs, obj_filter, limit, max_depth):
+                for ready in order.resolve(obj):
+                    yield ready
+            for obj in toposort(order.remaining(), allow_cycles=allow_cycles):
+                yield obj
+        return emit()
+
+    def process_keys(self, objs, obj_filter=None, limit=None, max_depth=None, using=None):
+        """
+        Generate a list of ``ObjectKey``s to serialize, one depth level at a
+        time, from the ``ObjectKey``s in ``objs``.
+
+        Finds the same objects and dependencies as ``process_levels``, but
+        without keeping any model instances around.
+        """
+        self.start_traversal(obj_filter)
+
+        level = list(objs)
+        self.prune_relations(set(key.model for key in level))
+        depth = 0
+        while level:
+            level = [key for key in level
+                     if self.process_object(key, obj_filter) is not None]
+            by_model = defaultdict(list)
+            for key in level:
+                by_model[key.model].append(key)
+            level = []
+            for model, keys in by_model.items():
+                level.extend(self.process_model_keys(
+                    model, keys, depth, obj_filter, limit, max_depth, using))
+            depth += 1
+
+    def fetch_objects(self, keys, using=None):
+        """
+        Yield the model instances of the ``ObjectKey``s in ``keys``, in order.
+
+        Consecutive keys of the same model are fetched together, at most
+        ``CHUNK_SIZE`` at a time, so only one chunk of instances is in memory
+        at once. The many-to-many primary keys of the chunk are read into
+        ``self.m2m_pks`` for the serializer.
+        """
+        for model, group in groupby(keys, key=lambda key: key.model):
+            plan = self.get_model_plan(model)
+            for chunk in chunked(list(group), settings.CHUNK_SIZE):
+                objs = model._base_manager.using(using).in_bulk([key.pk for key in chunk])
+                self.m2m_pks.clear()
+                for field in plan.serialized_m2m_fields:
+                    bulk_load_many2many(
+                        list(objs.values()), field, self.m2m_pks, False, settings.CHUNK_SIZE)
+                for key in chunk:
+                    if key.pk in objs:
+                        yield objs[key.pk]
+
+    def fetch_deferred(self, objs, using=None):
+        """
+        Yield the objects in ``objs`` in order, with all their fields loaded.
+
+        Objects loaded with deferred fields while traversing are fetched
+        again, ``CHUNK_SIZE`` consecutive objects of a model at a time.
+        """
+        for model, group in groupby(objs, key=lambda obj: obj._meta.model):
+            for chunk in chunked(list(group), settings.CHUNK_SIZE):
+                deferred = [obj.pk for obj in chunk if obj.get_deferred_fields()]
+                loaded = {}
+                if deferred:
+                    loaded = model._base_manager.using(using).in_bulk(deferred)
+                for obj in chunk:
+                    yield loaded.get(obj.pk, obj)
+
+    def copy_objects(self, objs, using=None):
+        """
+        Yield a ``DeserializedObject`` of a copy of each object in ``objs``,
+        as ``object_load`` would read it from a fixture, with the primary
+        keys of its serialized many-to-many fields read ``CHUNK_SIZE``
+        objects at a time.
+
+        The objects are copied as they come in, as ``defer_foreign_keys``
+        restores their foreign keys after yielding them.
+        """
+        for model, group in groupby(objs, key=lambda obj: obj._meta.model):
+            m2m_fields = self.get_model_plan(model).serialized_m2m_fields
+            for chunk in iter(lambda: [copy.copy(obj) for obj in islice(group, settings.CHUNK_SIZE)], []):
+                m2m_data = defaultdict(dict)  # {obj index: {field name: related pks}}
+                for field in m2m_fields:
+                    through = field.remote_field.through
+                    attname = through._meta.get_field(field.m2m_field_name()).target_field.attname
+                    related = fetch_many2many_keys(
+                        field, [getattr(obj, attname) for obj in chunk], using, settings.CHUNK_SIZE)
+                    for index, obj in enumerate(chunk):
+                        m2m_data[index][field.name] = related[getattr(obj, attname)]
+                for index, obj in enumerate(chunk):
+                    yield DeserializedObject(obj, m2m_data=m2m_data[index])
+
+    def is_nullable_fk(self, index):
+        """
+        Can the dependency edge ``index`` of the graph be left out by setting
+        a foreign key to null?
+        """
+        label = self.graph.labels[index]
+        if label < 0:
+            return False
+        opts = self.graph.objects[self.graph.sources[index]]._meta
+        try:
+            field = opts.get_field(self.graph.label_names[label])
+        except FieldDoesNotExist:
+            return False
+        return isinstance(field, models.ForeignKey) and field.null
+
+    def check_cycles(self, breakcycles=False, no_cycles=False):
+        """
+        Return the dependency edges of the graph to leave out to break its
+        cycles, recording the foreign keys to defer in ``self.deferred_fks``.
+
+        The cycles left are reported in verbose mode, and raise a
+        ``CommandError`` if ``no_cycles``.
+        """
+        cut = set()
+        if breakcycles:
+            cut = break_cycles(self.graph, self.is_nullable_fk)
+            for index in cut:
+                obj = self.graph.objects[self.graph.sources[index]]
+                field = obj._meta.get_field(self.graph.label_names[self.graph.labels[index]])
+                self.deferred_fks.setdefault((obj._meta.concrete_model, obj.pk), []).append(field)
+            if self.verbose:
+                pprint.pprint("Deferred %s foreign keys of %s objects to break cycles" % (
+                    len(cut), len(self.deferred_fks)), stream=self.stderr)
+        if self.verbose or no_cycles:
+            edges = get_dependency_edges(self.graph, cut)
+            report = describe_cycles(self.graph, edges, find_cycles(edges))
+            if report and no_cycles:
+                raise CommandError("Cyclic dependencies exist:\n%s" % "\n".join(report))
+            for line in report:
+                pprint.pprint("Cycle of %s" % line, stream=self.stderr)
+        return cut
+
+    def defer_foreign_keys(self, objs):
+        """
+        Yield ``objs`` with the foreign keys in ``self.deferred_fks`` set to
+        null, then the objects with deferred foreign keys again, as they are
+        """
+        patches = []
+        for obj in objs:
+            fields = self.deferred_fks.get((obj._meta.concrete_model, obj.pk))
+            if not fields:
+                yield obj
+                continue
+            values = [(field, getattr(obj, field.attname)) for field in fields]
+            for field in fields:
+                setattr(obj, field.name, None)
+            yield obj
+            for field, value in values:
+                setattr(obj, field.attname, value)
+            patches.append(obj)
+        for obj in patches:
+            yield obj
 
     def handle(self, *args, **options):
         format = options.get('format')
@@ -377,13 +964,47 @@ class Command(BaseCommand):
         model_diagram_file = options.get("modeldiagram")
         object_diagram_file = options.get("objdiagram")
         no_cycles = options.get("nocycles")
+        batch = options.get("batch")
+        keys_only = options.get("keys_only")
+        output = options.get("output")
+        compress = options.get("compress")
+        compresslevel = options.get("compresslevel")
+        buffer_size = options.get("buffer_size") or settings.BUFFER_SIZE
+        shard_dir = options.get("shard_dir")
+        shard_objects = options.get("shard_objects")
+        shard_size = options.get("shard_size")
+        copy_to = options.get("copy_to")
+        self.identity_map_size = options.get("identity_map_size")
+        hash_manifest = options.get("hash_manifest")
+        since_manifest = options.get("since_manifest")
+        self.order = options.get("order") or "object"
+        breakcycles = options.get("breakcycles")
 
+        if compress and not (output or shard_dir):
+            raise CommandError("You can only compress output written to a file with --output or --shard-dir.")
+        if shard_dir and (output or self.order == 'online'):
+            raise CommandError("You can't use --shard-dir with --output or --order online.")
+        if copy_to and (output or shard_dir):
+            raise CommandError("You can't use --copy-to with --output or --shard-dir.")
+        if since_manifest and not hash_manifest:
+            raise CommandError("You must write a new manifest, with the deletions, with --hash-manifest.")
+        if breakcycles and self.order != 'object':
+            raise CommandError("You can only break cycles with --order object.")
+        if self.order == 'online' and (keys_only or debug or model_diagram_file or object_diagram_file):
+            raise CommandError("You can't use --order online with --keys-only, --debug or diagrams.")
         SerializerClass = get_serializer(format)()  # NOQA
         self.use_gfks = hasattr(SerializerClass, 'handle_gfk_field')
         if model_diagram_file and object_diagram_file:
             raise CommandError("You can't generate a model diagram and an object diagram at the same time.")
         self.use_obj_key = model_diagram_file is None
         self.verbose = int(options.get('verbosity')) > 1
+        # Debug, diagram and verbose output show the objects, which may read
+        # any field.
+        self.defer_fields = batch and not (
+            debug or model_diagram_file or object_diagram_file or self.verbose)
+        # Ordering by model needs no object-level graph.
+        self.record_edges = self.order != 'model' or bool(
+            debug or model_diagram_file or object_diagram_file)
         id_cast = {
             'int': int,
         }[options.get('idtype')]
@@ -403,16 +1024,33 @@ class Command(BaseCommand):
         ids = [id_cast(i) for i in args[1:]]
 
         # Lookup initial model records.
+        queryset = primary_model.objects.using(using)
         if ids:
-            objs = primary_model.objects.using(using).filter(pk__in=ids).iterator()
-        else:
-            objs = primary_model.objects.using(using).iterator()
+            queryset = queryset.filter(pk__in=ids)
 
-        self.process_queue(objs, obj_filter, limit, max_depth)
+        if self.order == 'online':
+            # The objects are traversed while they are serialized.
+            serialization_order = self.process_online(
+                queryset.iterator(), obj_filter, limit, max_depth, batch,
+                allow_cycles=not no_cycles)
+        elif keys_only:
+            keys = (ObjectKey.for_model(primary_model, pk)
+                    for pk in queryset.values_list('pk', flat=True).iterator())
+            self.process_keys(keys, obj_filter, limit, max_depth, using)
+        elif batch:
+            self.process_levels(queryset.iterator(), obj_filter, limit, max_depth)
+        else:
+            self.process_queue(queryset.iterator(), obj_filter, limit, max_depth)
 
         # Order serialization so that dependents come after dependencies.
-        depends_on = dict(self.depends_on)
-        serialization_order = toposort(depends_on, allow_cycles=not no_cycles)
+        self.deferred_fks = {}
+        cut = set()
+        if self.order == 'model':
+            serialization_order = self.order_by_model(allow_cycles=not no_cycles)
+        elif self.order == 'object':
+            cut = self.check_cycles(breakcycles, no_cycles)
+            depends_on = self.graph.dependencies(cut)
+            serialization_order = toposort(depends_on, allow_cycles=not no_cycles)
         try:
             try:
                 self.stdout.ending = None
@@ -422,11 +1060,11 @@ class Command(BaseCommand):
                 pprint.pprint("----------------------------------------------", stream=self.stderr)
                 pprint.pprint("Which models cause which others to be included", stream=self.stderr)
                 pprint.pprint("----------------------------------------------", stream=self.stderr)
-                pprint.pprint(dict(self.generates), stream=self.stderr)
+                pprint.pprint(self.graph.generates(self.get_obj_key), stream=self.stderr)
                 pprint.pprint("----------------------------------------------", stream=self.stderr)
                 pprint.pprint("Dependencies", stream=self.stderr)
                 pprint.pprint("----------------------------------------------", stream=self.stderr)
-                for model, fields in sorted(self.relationships.items()):
+                for model, fields in sorted(self.graph.relationships(self.get_obj_key).items()):
                     pprint.pprint(model, stream=self.stderr)
                     for field, items in sorted(fields.items()):
                         pprint.pprint("     %s" % field, stream=self.stderr)
@@ -438,20 +1076,99 @@ class Command(BaseCommand):
                 pprint.pprint(list(serialization_order), stream=self.stderr)
                 return
             if model_diagram_file:
-                make_dot(self.relationships, model_diagram_file)
+                make_dot(self.graph.relationships(self.get_obj_key), model_diagram_file)
             elif object_diagram_file:
-                make_dot(self.relationships, object_diagram_file)
-            to_serialize = [o for o in list(serialization_order) if o is not None]
+                make_dot(self.graph.relationships(self.get_obj_key), object_diagram_file)
+            to_serialize = (o for o in serialization_order if o is not None)
             if self.verbose:
+                to_serialize = list(to_serialize)
                 pprint.pprint(to_serialize, stream=self.stderr)
             fields, excluded = get_fields()
-            SerializerClass.serialize(
-                to_serialize,
-                indent=indent,
-                use_natural_keys=use_natural_keys,
-                stream=self.stdout,
-                fields=fields,
-                exclude_fields=excluded)
+            layers = self.get_layers(cut) if shard_dir else None
+            # The fast serializer reads the rows itself, but can't output
+            # foreign keys deferred in memory.
+            fast_serializer = None
+            if not (self.deferred_fks or copy_to):
+                fast_serializer = get_fast_serializer(format, use_natural_keys)
+            if fast_serializer is None:
+                if keys_only:
+                    to_serialize = self.fetch_objects(to_serialize, using)
+                elif self.defer_fields:
+                    to_serialize = self.fetch_deferred(to_serialize, using)
+            delta = None
+            if hash_manifest:
+                # Before the foreign keys are deferred.
+                delta = DeltaFilter(
+                    read_manifest(since_manifest) if since_manifest else None,
+                    using, settings.CHUNK_SIZE,
+                    lambda model: self.get_model_plan(model).serialized_m2m_fields,
+                    layers, self.m2m_pks)
+                to_serialize = delta(to_serialize)
+            if fast_serializer is None and self.deferred_fks:
+                to_serialize = self.defer_foreign_keys(to_serialize)
+
+            def serialize(objs, stream):
+                if fast_serializer is not None:
+                    fast_serializer.serialize(
+                        objs,
+                        indent=indent,
+                        stream=stream,
+                        fields=fields,
+                        exclude_fields=excluded,
+                        m2m_pks=self.m2m_pks,
+                        using=using,
+                        chunk_size=settings.CHUNK_SIZE)
+                else:
+                    SerializerClass.serialize(
+                        objs,
+                        indent=indent,
+                        use_natural_keys=use_natural_keys,
+                        stream=stream,
+                        fields=fields,
+                        exclude_fields=excluded,
+                        m2m_pks=self.m2m_pks)
+
+            if copy_to:
+                loader = BulkLoader(copy_to, settings.CHUNK_SIZE, options.get("conflict") or "fail")
+                with loader.atomic():
+                    loader.load(self.copy_objects(to_serialize, using))
+                if self.verbose:
+                    pprint.pprint("Copied %s objects to %s" % (loader.object_count, copy_to),
+                                  stream=self.stderr)
+            elif shard_dir:
+                writer = ShardWriter(
+                    shard_dir, format, serialize, shard_objects, shard_size,
+                    compress, compresslevel, buffer_size)
+                manifest = writer.write(to_serialize, layers)
+                if self.verbose:
+                    pprint.pprint("Wrote %s shards in %s layers" % (
+                        len(manifest['shards']),
+                        len(set(shard['layer'] for shard in manifest['shards']))),
+                        stream=self.stderr)
+            else:
+                out = self.stdout
+                if output:
+                    out = open_output(output, compress, compresslevel)
+                try:
+                    stream = BufferedStream(out, buffer_size)
+                    serialize(to_serialize, stream)
+                    stream.flush()
+                finally:
+                    if output:
+                        out.close()
+
+            if delta is not None:
+                manifest = delta.manifest()
+                write_manifest(hash_manifest, manifest)
+                if self.verbose:
+                    pprint.pprint("%s objects changed, %s unchanged, %s deleted" % (
+                        delta.changed, delta.unchanged,
+                        sum(len(pks) for pks in manifest['deleted'].values())),
+                        stream=self.stderr)
+            if self.verbose and self.identity_map is not None:
+                pprint.pprint("Identity map: %s hits, %s misses, %s objects" % (
+                    self.identity_map.hits, self.identity_map.misses, len(self.identity_map)),
+                    stream=self.stderr)
         except Exception as e:
             if show_traceback:
                 raise
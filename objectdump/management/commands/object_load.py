@@ -0,0 +1,115 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS
+
+# If importing MODEL_SETTINGS directly, the tests can't update the settings between tests.
+from ... import settings
+from ...delta import read_manifest
+from ...loader import CONFLICTS, BulkLoader, delete_objects, iter_fixtures, read_fixture
+from ...remap import Remapper
+
+
+class Command(BaseCommand):
+    help = ("Load fixtures written by object_dump, inserting consecutive objects "
+            "of a model in bulk, in one transaction.")
+    args = "fixture [fixture ...]"
+
+    def add_arguments(self, parser):
+        parser.add_argument("fixture", nargs="+")
+        parser.add_argument(
+            "--database",
+            action="store",
+            dest="database",
+            default=DEFAULT_DB_ALIAS,
+            help="Nominates a specific database to load fixtures into. "
+            'Defaults to the "default" database.',
+        )
+        parser.add_argument(
+            "--format",
+            dest="format",
+            default=None,
+            help="The serialization format of the fixtures. Defaults to their suffix, "
+            "or to the format in the manifest of a --shard-dir directory.",
+        )
+        parser.add_argument(
+            "--batch-size",
+            dest="batch_size",
+            default=None,
+            type=int,
+            help="The maximum number of objects inserted by one query. Defaults to the CHUNK_SIZE setting.",
+        )
+        parser.add_argument(
+            "--conflict",
+            dest="conflict",
+            default="fail",
+            choices=CONFLICTS,
+            help="What to do with objects whose primary key is already in the database: "
+            "fail, skip them or update the rows. Defaults to fail.",
+        )
+        parser.add_argument(
+            "--remap-pks",
+            action="store_true",
+            dest="remap_pks",
+            default=False,
+            help="Give the objects new primary keys, after the largest ones in the database, "
+            "and point the references to them at the new keys.",
+        )
+        parser.add_argument(
+            "--deletions",
+            dest="deletions",
+            default=None,
+            help="A --hash-manifest written by object_dump --since-manifest. The objects it "
+            "lists as deleted are deleted after the fixtures are loaded.",
+        )
+
+    def handle(self, *args, **options):
+        using = options.get('database')
+        verbosity = int(options.get('verbosity'))
+        show_traceback = options.get('traceback')
+        batch_size = options.get('batch_size') or settings.CHUNK_SIZE
+        remapper = None
+        if options.get('remap_pks'):
+            remapper = Remapper(using, settings.PK_MAP_SIZE)
+        loader = BulkLoader(using, batch_size, options.get('conflict') or 'fail', remapper)
+
+        fixtures = list(iter_fixtures(options['fixture'], options.get('format')))
+        deleted = {}
+        if options.get('deletions'):
+            deleted = read_manifest(options['deletions']).get('deleted', {})
+        deleted_count = 0
+        try:
+            with loader.atomic():
+                if remapper is not None:
+                    # The fixtures are read twice, so that objects can point
+                    # at objects that come after them.
+                    for path, format in fixtures:
+                        remapper.reserve(read_fixture(path, format, using), batch_size)
+                for path, format in fixtures:
+                    if verbosity >= 2:
+                        self.stdout.write("Installing fixture '%s'." % path)
+                    try:
+                        loader.load(read_fixture(path, format, using))
+                    except Exception as e:
+                        if show_traceback:
+                            raise
+                        raise CommandError("Problem installing fixture '%s': %s" % (path, e))
+                deleted_count = delete_objects(deleted, using, batch_size)
+        except CommandError:
+            raise
+        except Exception as e:
+            # The constraints are checked at the end of the transaction.
+            if show_traceback:
+                raise
+            raise CommandError("Problem installing fixtures: %s" % e)
+        finally:
+            if remapper is not None:
+                remapper.close()
+
+        if verbosity >= 1:
+            if loader.object_count == loader.fixture_object_count:
+                self.stdout.write("Installed %d object(s) from %d fixture(s)" % (
+                    loader.object_count, len(fixtures)))
+            else:
+                self.stdout.write("Installed %d object(s) (of %d) from %d fixture(s)" % (
+                    loader.object_count, loader.fixture_object_count, len(fixtures)))
+            if options.get('deletions'):
+                self.stdout.write("Deleted %d object(s)" % deleted_count)
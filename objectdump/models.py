@@ -7,12 +7,38 @@ try:
 
     def get_app(app_label):
         return apps.get_app_config(app_label).models_module
+
+    def get_models():
+        return apps.get_models(include_auto_created=True)
 except ImportError:
-    from django.db.models import get_model, get_app
+    from django.db.models import get_model, get_app, get_models
+
+from collections import namedtuple
 
 from django.core.exceptions import ImproperlyConfigured
 
-from .settings import MODEL_SETTINGS
+# If importing MODEL_SETTINGS directly, the tests can't update the settings between tests.
+from . import settings
+
+
+class ObjectKey(namedtuple('ObjectKey', ['model', 'pk'])):
+    """
+    A stand-in for a model instance that only knows its model and primary
+    key. It has the ``_meta`` and ``pk`` the traversal and ``toposort`` use.
+    """
+    __slots__ = ()
+
+    @classmethod
+    def for_model(cls, model, pk):
+        # Proxies are the same rows as their concrete model.
+        return cls(model._meta.concrete_model, pk)
+
+    @property
+    def _meta(self):
+        return self.model._meta
+
+    def __repr__(self):
+        return "<%s: %s>" % (self.model.__name__, self.pk)
 
 
 def get_key(obj, as_tuple=False, include_pk=True):
@@ -87,10 +113,9 @@ class ObjectFilter(object):
         if self.primary_model is None:
             raise Exception("Unknown primary model: %s" % primary_model)
 
-        if exclude_list is None:
-            exclude_list = []
+        exclude_list = list(exclude_list or [])
 
-        for model, attrs in MODEL_SETTINGS.items():
+        for model, attrs in settings.MODEL_SETTINGS.items():
             if attrs.get('ignore', False):
                 exclude_list.append(model)
 
@@ -99,21 +124,40 @@ class ObjectFilter(object):
         self.included_apps, self.included_models = get_apps_and_models(
             include_list)
 
-    def skip(self, obj):
+        self._skip = {}
+        for model in get_models():
+            self._skip[model] = self._decide(model)
+
+    def _decide(self, model):
         # Skip ignored models.
-        if obj.__class__ in self.excluded_models:
+        if model in self.excluded_models:
             return True
 
-        if get_app(obj._meta.app_label) in self.excluded_apps:
+        if get_app(model._meta.app_label) in self.excluded_apps:
             return True
 
         # Skip models not specifically being included.
         if ((self.included_apps or self.included_models) and
-            not isinstance(obj, self.primary_model)):
-            if obj.__class__ not in self.included_models:
+            not issubclass(model, self.primary_model)):
+            if model not in self.included_models:
                 return True
 
-            if get_app(obj._meta.app_label) not in self.included_apps:
+            if get_app(model._meta.app_label) not in self.included_apps:
                 return True
 
         return False
+
+    def skip_model(self, model):
+        """
+        Should objects of ``model`` be skipped? The decision is looked up in
+        a table built when the filter is created; models not in it are
+        decided and added the first time they are seen.
+        """
+        try:
+            return self._skip[model]
+        except KeyError:
+            decision = self._skip[model] = self._decide(model)
+            return decision
+
+    def skip(self, obj):
+        return self.skip_model(obj._meta.model)
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+"""
+Open the file the serialized output is written to, compressed as it is
+written with the standard library's gzip, bz2 or lzma.
+"""
+import bz2
+import gzip
+import hashlib
+import io
+import lzma
+import os
+
+COMPRESSORS = {
+    'gzip': gzip.open,
+    'bz2': bz2.open,
+    'lzma': lzma.open,
+}
+
+SUFFIXES = {
+    '.gz': 'gzip',
+    '.bz2': 'bz2',
+    '.xz': 'lzma',
+    '.lzma': 'lzma',
+}
+
+EXTENSIONS = {
+    'gzip': '.gz',
+    'bz2': '.bz2',
+    'lzma': '.xz',
+}
+
+
+def get_compression(path, compress=None):
+    """
+    Return the name of the compressor for ``path``: ``compress`` if given,
+    else the one its suffix names, or ``None`` for no compression
+    """
+    if compress:
+        return compress
+    return SUFFIXES.get(os.path.splitext(path)[1].lower())
+
+
+def open_output(path, compress=None, level=None, fileobj=None):
+    """
+    Open ``path`` for writing text, compressed with the ``get_compression``
+    compressor at ``level``. The compressor's default level is used if
+    ``level`` is ``None``. The bytes are written to ``fileobj`` instead of
+    the file if given.
+    """
+    compression = get_compression(path, compress)
+    if compression is None:
+        if fileobj is None:
+            return open(path, 'w', encoding='utf-8')
+        return io.TextIOWrapper(io.BufferedWriter(fileobj), encoding='utf-8')
+    options = {}
+    if level is not None:
+        options['preset' if compression == 'lzma' else 'compresslevel'] = level
+    return COMPRESSORS[compression](
+        path if fileobj is None else fileobj, 'wt', encoding='utf-8', **options)
+
+
+class HashingFile(io.RawIOBase):
+    """
+    A file open for writing that keeps the SHA-256 and the size of the bytes
+    written to it
+    """
+    def __init__(self, path):
+        self.file = open(path, 'wb')
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.sha256.update(data)
+        self.size += len(data)
+        return self.file.write(data)
+
+    def close(self):
+        if not self.closed:
+            self.file.close()
+        super(HashingFile, self).close()
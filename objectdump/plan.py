@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+"""
+The relations followed from each model, compiled once per model class from
+its ``_meta`` and ``MODEL_SETTINGS``.
+"""
+from collections import namedtuple
+from itertools import chain
+
+from django.contrib.contenttypes.fields import GenericForeignKey
+from django.db.models import ForeignKey
+
+# If importing MODEL_SETTINGS directly, the tests can't update the settings between tests.
+from . import settings
+from .models import get_all_related_objects
+
+
+TraversalPlan = namedtuple('TraversalPlan', [
+    'model',
+    'key',  # 'app_label.model_name'
+    'reverse_relations',  # accessor names followed by process_related_fields
+    'reverse_fields',  # the ForeignObjectRel of the existing accessors
+    'm2m_relations',  # names followed by process_many2many
+    'm2m_fields',  # the ManyToManyFields of the existing names
+    'serialized_m2m_fields',  # ManyToManyFields the serializer outputs
+    'foreign_keys',  # ForeignKey fields followed by process_foreignkeys
+    'generic_foreign_keys',  # GenericForeignKeys followed by process_genericforeignkeys
+    'addl_relations',
+    'pruned',  # (name, target model) of relations the filter always skips
+    'traversal_fields',  # field names traversal reads, or None for all of them
+])
+
+
+def get_all_field_names(model):
+    return list(set(chain.from_iterable(
+        (field.name, field.attname) if hasattr(field, 'attname') else (field.name,)
+        for field in model._meta.get_fields()
+        # For complete backwards compatibility, you may want to exclude
+        # GenericForeignKey from the results.
+        if not (field.many_to_one and field.related_model is None)
+    )))
+
+
+def get_configured_fields(model_settings, setting, all_fields):
+    """
+    Return the field names configured in ``model_settings`` for ``setting``.
+
+    The setting could be True for all, False for none, or an iterable for
+    some of the fields. Missing settings mean all fields.
+    """
+    fields = model_settings.get(setting, all_fields)
+    if fields is True:
+        return all_fields
+    elif fields is False:
+        return []
+    return fields
+
+
+def get_model_dependencies(model):
+    """
+    Return the models whose rows ``model`` rows point at, from the schema.
+
+    Like ``django.core.serializers.sort_dependencies``, but from the
+    foreign keys (including parent links) and the many-to-many fields with
+    auto-created through tables, which are serialized with the rows.
+    """
+    opts = model._meta.concrete_model._meta
+    dependencies = set()
+    for field in opts.fields:
+        if field.remote_field is not None and field.related_model is not None:
+            dependencies.add(field.related_model._meta.concrete_model)
+    for field in opts.many_to_many:
+        if field.remote_field.through._meta.auto_created:
+            dependencies.add(field.related_model._meta.concrete_model)
+    dependencies.discard(opts.concrete_model)
+    return dependencies
+
+
+def get_traversal_fields(model, reverse_fields, m2m_fields, foreign_keys,
+                         generic_foreign_keys, addl_relations):
+    """
+    Return the names of the fields of ``model`` that are read to follow its
+    relations, or ``None`` when all of them may be.
+
+    Additional relations are arbitrary code, so they get complete objects.
+    """
+    if addl_relations:
+        return None
+    opts = model._meta
+    names = [opts.pk.name]
+    names.extend(rel.field.target_field.name for rel in reverse_fields)
+    for field in m2m_fields:
+        through = field.remote_field.through
+        source = through._meta.get_field(field.m2m_field_name())
+        names.append(source.target_field.name)
+    names.extend(field.name for field in foreign_keys)
+    for field in generic_foreign_keys:
+        names.extend([field.ct_field, field.fk_field])
+    return tuple(dict.fromkeys(names))
+
+
+def compile_plan(model, obj_filter=None):
+    """
+    Return the ``TraversalPlan`` of ``model``
+
+    Relations to a model that ``obj_filter`` always skips are pruned from the
+    plan, so they are never queried, and listed in ``pruned``.
+    """
+    opts = model._meta
+    key = ".".join([opts.app_label, opts.model_name])
+    model_settings = settings.MODEL_SETTINGS.get(key, {})
+
+    related_objs = get_all_related_objects(model)
+    accessors = [rel.get_accessor_name() for rel in related_objs]
+    reverse_relations = get_configured_fields(
+        model_settings, 'reverse_relations', accessors)
+
+    m2m_names = [field.name for field in opts.many_to_many]
+    m2m_relations = get_configured_fields(model_settings, 'm2m_fields', m2m_names)
+
+    fk_fields = get_configured_fields(
+        model_settings, 'fk_fields', get_all_field_names(model))
+    gfk_fields = get_configured_fields(
+        model_settings, 'gfk_fields', [x.name for x in opts.private_fields])
+
+    reverse_fields = [
+        rel for rel in related_objs
+        if rel.get_accessor_name() in reverse_relations]
+    m2m_fields = [
+        field for field in opts.many_to_many if field.name in m2m_relations]
+    foreign_keys = [
+        field for field in opts.fields
+        if isinstance(field, ForeignKey) and field.name in fk_fields]
+
+    pruned = []
+    if obj_filter is not None:
+        for rel in reverse_fields:
+            if obj_filter.skip_model(rel.related_model):
+                pruned.append((rel.get_accessor_name(), rel.related_model))
+        for field in m2m_fields + foreign_keys:
+            if obj_filter.skip_model(field.related_model):
+                pruned.append((field.name, field.related_model))
+    pruned_names = set(name for name, target in pruned)
+
+    reverse_fields = [
+        rel for rel in reverse_fields if rel.get_accessor_name() not in pruned_names]
+    m2m_fields = [field for field in m2m_fields if field.name not in pruned_names]
+    foreign_keys = [field for field in foreign_keys if field.name not in pruned_names]
+    serialized_m2m_fields = [
+        field for field in opts.concrete_model._meta.many_to_many
+        if field.serialize and field.remote_field.through._meta.auto_created]
+    generic_foreign_keys = [
+        field for field in opts.private_fields
+        if isinstance(field, GenericForeignKey) and field.name in gfk_fields]
+    addl_relations = model_settings.get('addl_relations', [])
+
+    return TraversalPlan(
+        model=model,
+        key=key,
+        reverse_relations=tuple(
+            name for name in reverse_relations if name not in pruned_names),
+        reverse_fields=tuple(reverse_fields),
+        m2m_relations=tuple(
+            name for name in m2m_relations if name not in pruned_names),
+        m2m_fields=tuple(m2m_fields),
+        serialized_m2m_fields=tuple(serialized_m2m_fields),
+        foreign_keys=tuple(foreign_keys),
+        generic_foreign_keys=tuple(generic_foreign_keys),
+        addl_relations=tuple(addl_relations),
+        pruned=tuple(pruned),
+        traversal_fields=get_traversal_fields(
+            model, reverse_fields, m2m_fields + serialized_m2m_fields,
+            foreign_keys, generic_foreign_keys, addl_relations),
+    )
@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+"""
+Give the objects of a fixture new primary keys as they are loaded, and point
+their foreign keys, many-to-many rows and generic foreign keys at the new
+keys, so a fixture can be loaded into a database that already has rows.
+"""
+import sqlite3
+from collections import defaultdict
+from itertools import groupby, islice
+
+from django.db import DEFAULT_DB_ALIAS
+from django.db.models import Max
+
+from .bulk import chunked
+
+AUTO_FIELDS = ('AutoField', 'BigAutoField', 'SmallAutoField')
+
+# SQLite's default maximum number of query parameters, before 3.32
+SQLITE_MAX_VARIABLES = 999
+
+
+def is_auto_pk(model):
+    return model._meta.pk.get_internal_type() in AUTO_FIELDS
+
+
+def get_key_model(model):
+    """
+    The concrete model whose primary keys ``model``'s are: the model at the
+    end of a primary key relation, like the parent of a multi-table
+    inherited model, whose value it shares.
+    """
+    model = model._meta.concrete_model
+    while model._meta.pk.is_relation:
+        model = model._meta.pk.related_model._meta.concrete_model
+    return model
+
+
+class PkMap(object):
+    """
+    ``{(concrete model, old pk): new pk}``, with at most ``max_size`` keys
+    in memory. Past it, the keys in memory are moved to a temporary SQLite
+    database on disk, which SQLite deletes when it is closed.
+    """
+    def __init__(self, max_size=None):
+        self.max_size = max_size
+        self.memory = defaultdict(dict)  # {concrete model: {old pk: new pk}}
+        self.size = 0  # keys in memory
+        self.models = set()  # the models with keys
+        self.db = None
+
+    def open(self):
+        # An empty name is a private database in a temporary file.
+        self.db = sqlite3.connect('')
+        self.db.execute(
+            'CREATE TABLE pks (model TEXT, old, new, PRIMARY KEY (model, old)) WITHOUT ROWID')
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+
+    def add_many(self, model, pairs):
+        """
+        Add the ``(old pk, new pk)`` pairs of ``model``
+        """
+        keys = self.memory[model]
+        before = len(keys)
+        keys.update(pairs)
+        self.size += len(keys) - before
+        self.models.add(model)
+        if self.max_size is not None and self.size > self.max_size:
+            self.spill()
+
+    def spill(self):
+        if self.db is None:
+            self.open()
+        for model, keys in self.memory.items():
+            self.db.executemany(
+                'INSERT OR REPLACE INTO pks VALUES (?, ?, ?)',
+                ((model._meta.label, old, new) for old, new in keys.items()))
+        self.memory.clear()
+        self.size = 0
+
+    def get_many(self, model, pks):
+        """
+        Return ``{old pk: new pk}`` for the ``pks`` of ``model`` that have a
+        new key
+        """
+        if model not in self.models:
+            return {}
+        keys = self.memory.get(model, {})
+        found = dict((pk, keys[pk]) for pk in pks if pk in keys)
+        if self.db is not None:
+            missing = list(set(pk for pk in pks if pk not in found))
+            for chunk in chunked(missing, SQLITE_MAX_VARIABLES - 1):
+                found.update(self.db.execute(
+                    'SELECT old, new FROM pks WHERE model = ? AND old IN (%s)'
+                    % ', '.join('?' * len(chunk)),
+                    [model._meta.label] + chunk))
+        return found
+
+
+class Remapper(object):
+    """
+    Rewrite the batches of ``DeserializedObject``s ``BulkLoader`` loads.
+
+    The objects of a model with an auto-incremented primary key get the keys
+    after the largest one in the ``using`` database, counted up in memory, so
+    the loader must be the only writer of these tables until it resets their
+    sequences. ``reserve`` gives the keys of all the objects up front, so
+    objects can point at objects loaded after them, in cycles. Values
+    pointing at objects not loaded, like content types left out of the
+    fixture, are kept as they are.
+    """
+    def __init__(self, using=DEFAULT_DB_ALIAS, max_size=None):
+        self.using = using
+        self.pks = PkMap(max_size)
+        self.last = {}  # {concrete model: last pk given}
+        self.ct_models = {}  # {content type id: model}
+
+    def close(self):
+        self.pks.close()
+
+    def next_pks(self, model, count):
+        """
+        Reserve ``count`` new primary keys of ``model``
+        """
+        if model not in self.last:
+            last = model._base_manager.using(self.using).aggregate(last=Max('pk'))['last']
+            self.last[model] = last or 0
+        first = self.last[model] + 1
+        self.last[model] += count
+        return range(first, first + count)
+
+    def reserve(self, objects, batch_size=None):
+        """
+        Give the ``DeserializedObject``s in ``objects`` their new primary
+        keys, ``batch_size`` consecutive objects of a model at a time, before
+        any of them is rewritten
+        """
+        for model, group in groupby(objects, key=lambda obj: type(obj.object)):
+            concrete_model = model._meta.concrete_model
+            for batch in iter(lambda: list(islice(group, batch_size)), []):
+                if is_auto_pk(concrete_model):
+                    self.assign_pks(concrete_model, [obj.object for obj in batch],
+                                    [obj.object.pk for obj in batch])
+
+    def map_values(self, model, values):
+        """
+        Return ``values`` with the primary keys of ``model`` that have a new
+        key replaced
+        """
+        found = self.pks.get_many(get_key_model(model), [v for v in values if v is not None])
+        return [found.get(value, value) for value in values]
+
+    def rewrite(self, model, batch):
+        concrete_model = model._meta.concrete_model
+        objs = [obj.object for obj in batch]
+        # Before the foreign keys, which can point at objects of the batch.
+        if is_auto_pk(concrete_model):
+            self.assign_pks(concrete_model, objs, [obj.pk for obj in objs])
+        # A primary key that points at another model is rewritten here.
+        for field in model._meta.concrete_fields:
+            if field.is_relation and field.target_field.primary_key:
+                values = self.map_values(
+                    field.related_model, [getattr(obj, field.attname) for obj in objs])
+                for obj, value in zip(objs, values):
+                    setattr(obj, field.attname, value)
+        for field in model._meta.private_fields:
+            if hasattr(field, 'ct_field') and hasattr(field, 'fk_field'):
+                self.rewrite_generic(field, objs)
+        for obj in batch:
+            for name, values in (obj.m2m_data or {}).items():
+                field = model._meta.get_field(name)
+                through = field.remote_field.through
+                if through._meta.get_field(field.m2m_reverse_field_name()).target_field.primary_key:
+                    obj.m2m_data[name] = self.map_values(field.related_model, values)
+
+    def assign_pks(self, model, objs, old_pks):
+        """
+        Give ``objs`` new primary keys, or the ones they were given before
+        """
+        found = self.pks.get_many(model, old_pks)
+        fresh = [pk for pk in dict.fromkeys(old_pks) if pk is not None and pk not in found]
+        new_pks = dict(zip(fresh, self.next_pks(model, len(fresh))))
+        for obj, old in zip(objs, old_pks):
+            if old is not None:
+                obj.pk = found[old] if old in found else new_pks[old]
+        self.pks.add_many(model, new_pks.items())
+
+    def rewrite_generic(self, field, objs):
+        """
+        Point the generic foreign key ``field`` of ``objs`` at the new keys
+        """
+        from django.contrib.contenttypes.models import ContentType
+
+        ct_attname = field.model._meta.get_field(field.ct_field).attname
+        by_model = defaultdict(list)
+        for obj in objs:
+            ct_id = getattr(obj, ct_attname)
+            if ct_id is None or getattr(obj, field.fk_field) is None:
+                continue
+            if ct_id not in self.ct_models:
+                ct = ContentType.objects.db_manager(self.using).get_for_id(ct_id)
+                self.ct_models[ct_id] = ct.model_class()
+            by_model[self.ct_models[ct_id]].append(obj)
+        for model, model_objs in by_model.items():
+            if model is None:
+                continue
+            to_python = model._meta.pk.to_python
+            values = self.map_values(
+                model, [to_python(getattr(obj, field.fk_field)) for obj in model_objs])
+            for obj, value in zip(model_objs, values):
+                setattr(obj, field.fk_field, value)
@@ -1,6 +1,67 @@
-from io import StringIO
+from io import StringIO, TextIOBase
 from collections import defaultdict
 from django.contrib.contenttypes.fields import GenericRelation
+from django.utils.encoding import is_protected_type
+
+try:
+    import yaml
+    from django.core.serializers.pyyaml import DjangoSafeDumper
+    from django.core.serializers.pyyaml import Serializer as YAMLSerializer
+except ImportError:
+    YAMLSerializer = None
+
+
+class BufferedStream(TextIOBase):
+    """
+    Pass the text written to it on to ``stream`` in chunks of about ``size``
+    characters. ``stream`` itself is only flushed by ``flush``, as flushing a
+    compressed file hurts compression.
+    """
+    def __init__(self, stream, size=64 * 1024):
+        self.stream = stream
+        self.size = size
+        self.chunks = []
+        self.length = 0
+        self.written = 0  # characters written so far
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.chunks.append(data)
+        self.length += len(data)
+        self.written += len(data)
+        if self.length >= self.size:
+            self.write_chunks()
+        return len(data)
+
+    def write_chunks(self):
+        if self.chunks:
+            self.stream.write("".join(self.chunks))
+            self.chunks = []
+            self.length = 0
+
+    def flush(self):
+        self.write_chunks()
+        if hasattr(self.stream, 'flush'):
+            self.stream.flush()
+
+
+class StreamingYAMLSerializer(object):
+    """
+    Write each object as soon as it is serialized, as a one item list,
+    instead of the whole list at the end. The output is the same.
+    """
+    def end_object(self, obj):
+        super(StreamingYAMLSerializer, self).end_object(obj)
+        self.options.setdefault("allow_unicode", True)
+        yaml.dump(self.objects, self.stream, Dumper=DjangoSafeDumper, **self.options)
+        self.objects = []
+
+    def end_serialization(self):
+        # An empty list is written as "[]".
+        if self.first:
+            super(StreamingYAMLSerializer, self).end_serialization()
 
 
 class PerObjectSerializer(object):
@@ -57,6 +118,22 @@ class PerObjectSerializer(object):
         self.cached_selected_fields[key] = list(selected_fields)
         return self.cached_selected_fields[key]
 
+    def handle_m2m_pks(self, obj, field):
+        """
+        Serialize a many-to-many field from the primary keys already read
+        from its through table, if possible. Return True if it was handled.
+        """
+        pks = self.m2m_pks.get(field, {}).get(obj.pk)
+        if (pks is None
+                or not hasattr(self, '_current')
+                or not field.remote_field.through._meta.auto_created):
+            return False
+        if self.use_natural_foreign_keys and hasattr(field.remote_field.model, 'natural_key'):
+            return False
+        self._current[field.name] = [
+            pk if is_protected_type(pk) else str(pk) for pk in pks]
+        return True
+
     def serialize(self, queryset, **options):
         """
         Serialize a queryset.
@@ -64,6 +141,8 @@ class PerObjectSerializer(object):
         ``fields`` now accepts a dict of {'app_label.model': ['field1', ...]}
         ``exclude_fields`` accepts a dict in the above format. These fields
         are removed from all fields
+        ``m2m_pks`` accepts a dict of {m2m field: {obj pk: [related pks]}}
+        used instead of querying the many-to-many fields
 
         """
         self.options = options
@@ -75,6 +154,7 @@ class PerObjectSerializer(object):
 
         included_fields = options.pop("fields", {})
         excluded_fields = options.pop("exclude_fields", {})
+        self.m2m_pks = options.pop("m2m_pks", {})
         self.cached_selected_fields = defaultdict(set)
 
         self.start_serialization()
@@ -100,7 +180,8 @@ class PerObjectSerializer(object):
             for field in concrete_model._meta.many_to_many:
                 if field.serialize:
                     if self.selected_fields is None or field.attname in self.selected_fields:
-                        self.handle_m2m_field(obj, field)
+                        if not self.handle_m2m_pks(obj, field):
+                            self.handle_m2m_field(obj, field)
             if self.use_gfks:
                 # Ref: https://docs.djangoproject.com/en/1.10/_modules/django/db/models/options/
                 # Looks like a simple rename from "_meta.virtual_fields" to "_meta.private_fields"
@@ -115,6 +196,27 @@ class PerObjectSerializer(object):
 
 
 def get_serializer(format='json'):
+    from django.core.serializers import SerializerDoesNotExist
     from django.core.serializers import get_serializer as dj_get_ser
-    s = dj_get_ser(format)
-    return type('CustomSerializer', (PerObjectSerializer, s), {})
+    try:
+        s = dj_get_ser(format)
+    except SerializerDoesNotExist:
+        if format != 'jsonl':
+            raise
+        from .jsonl import Serializer as s
+    bases = (PerObjectSerializer, s)
+    if YAMLSerializer is not None and issubclass(s, YAMLSerializer):
+        bases = (StreamingYAMLSerializer, ) + bases
+    return type('CustomSerializer', bases, {})
+
+
+def get_deserializer(format='json'):
+    from django.core.serializers import SerializerDoesNotExist
+    from django.core.serializers import get_deserializer as dj_get_deser
+    try:
+        return dj_get_deser(format)
+    except SerializerDoesNotExist:
+        if format != 'jsonl':
+            raise
+        from .jsonl import Deserializer
+        return Deserializer
@@ -3,7 +3,15 @@ from django.conf import settings as site_settings
 
 
 DEFAULT_SETTINGS = {
-    'MODEL_SETTINGS': {}
+    'MODEL_SETTINGS': {},
+    # Max number of parent objects in one bulk query
+    'CHUNK_SIZE': 1000,
+    # Number of characters of output collected before writing them out
+    'BUFFER_SIZE': 64 * 1024,
+    # Number of remapped primary keys kept in memory before moving them to disk
+    'PK_MAP_SIZE': 1000000,
+    # Number of objects kept to be reused when a foreign key points at them again
+    'IDENTITY_MAP_SIZE': 10000,
 }
 
 USER_SETTINGS = DEFAULT_SETTINGS.copy()
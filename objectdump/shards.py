@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+"""
+Write the serialized objects to a directory of fixture shards, with a
+manifest of the layer each shard can be loaded in.
+"""
+import json
+import os
+from itertools import chain, groupby
+
+from .output import EXTENSIONS, HashingFile, open_output
+from .serializer import BufferedStream
+
+MANIFEST = 'manifest.json'
+
+
+class Layers(object):
+    """
+    Assign the objects of a dependency ordered stream to layers. An object's
+    layer comes after the layers of its dependencies, so the shards of a
+    layer only depend on earlier layers and can be loaded concurrently.
+
+    ``dependencies`` is ``{node: nodes it depends on}``, where ``key(obj)``
+    is the node of an object. From the first object with a dependency not
+    seen yet, i.e. in a cycle, all the objects go to one cyclic layer, whose
+    shards must be loaded together. Objects seen again, with the foreign keys
+    deferred to break cycles, go to one last layer.
+    """
+    def __init__(self, dependencies, key):
+        self.dependencies = dependencies
+        self.key = key
+        self.layers = {}  # {node: layer}
+        self.seen = set()  # (concrete model, pk) of the objects seen
+        self.top = -1  # the last layer so far
+        self.fixed = None  # the layer of all the objects from now on
+        self.patching = False
+        self.cyclic = set()
+
+    def __call__(self, obj):
+        ident = (obj._meta.concrete_model, obj.pk)
+        if ident in self.seen:
+            if not self.patching:
+                self.patching = True
+                self.fixed = self.top = self.top + 1
+        else:
+            self.seen.add(ident)
+        if self.fixed is not None:
+            return self.fixed
+        node = self.key(obj)
+        if node in self.layers:
+            return self.layers[node]
+        layer = 0
+        for dep in self.dependencies.get(node, ()):
+            if dep == node:
+                continue
+            if dep not in self.layers:
+                self.fixed = self.top = self.top + 1
+                self.cyclic.add(self.fixed)
+                return self.fixed
+            layer = max(layer, self.layers[dep] + 1)
+        self.layers[node] = layer
+        self.top = max(self.top, layer)
+        return layer
+
+
+class ShardWriter(object):
+    """
+    Split the objects by layer and model, and in shards of at most
+    ``max_objects`` objects, or about ``max_size`` characters of output, at
+    most one serializer chunk past it. ``serialize(objs, stream)`` writes
+    each shard, a complete fixture.
+    """
+    def __init__(self, directory, format, serialize, max_objects=None, max_size=None,
+                 compress=None, level=None, buffer_size=64 * 1024):
+        self.directory = directory
+        self.format = format
+        self.serialize = serialize
+        self.max_objects = max_objects
+        self.max_size = max_size
+        self.compress = compress
+        self.level = level
+        self.buffer_size = buffer_size
+        self.shards = []
+
+    def write(self, objs, layers):
+        """
+        Write the shards of ``objs``, then the manifest. Returns the manifest.
+        """
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        for (layer, model), group in groupby(objs, key=lambda obj: (layers(obj), obj._meta.model)):
+            for first in group:
+                self.write_shard(layer, model, chain([first], group))
+        manifest = {
+            'format': self.format,
+            'shards': self.shards,
+            'cyclic_layers': sorted(layers.cyclic),
+        }
+        with open(os.path.join(self.directory, MANIFEST), 'w') as f:
+            json.dump(manifest, f, indent=2)
+        return manifest
+
+    def write_shard(self, layer, model, objs):
+        """
+        Write a shard with the first objects of ``objs``, leaving the ones
+        past its limits in ``objs``
+        """
+        name = "%05d-%s.%s%s" % (
+            len(self.shards), model._meta.label_lower, self.format,
+            EXTENSIONS.get(self.compress, ''))
+        path = os.path.join(self.directory, name)
+        shard = {'file': name, 'layer': layer, 'models': [model._meta.label_lower], 'objects': 0}
+        fileobj = HashingFile(path)
+        try:
+            out = open_output(path, self.compress, self.level, fileobj)
+            stream = BufferedStream(out, self.buffer_size)
+
+            def limited():
+                for obj in objs:
+                    yield obj
+                    shard['objects'] += 1
+                    if shard['objects'] == self.max_objects:
+                        return
+                    if self.max_size and stream.written >= self.max_size:
+                        return
+            self.serialize(limited(), stream)
+            stream.flush()
+            out.close()
+        finally:
+            fileobj.close()
+        shard['sha256'] = fileobj.sha256.hexdigest()
+        shard['size'] = fileobj.size
+        self.shards.append(shard)
@@ -4,39 +4,136 @@ http://blog.jupo.org/2012/04/06/topological-sorting-acyclic-directed-graphs/
 """
 
 def get_item_key(item):
-    return f"{item.__class__.__module__}.{item.__class__.__name__}.{item.pk}"
+    model = item._meta.model
+    return f"{model.__module__}.{model.__name__}.{item.pk}"
 
-def toposort(data, allow_cycles=False):
-    from functools import reduce
+def get_model_key(model):
+    return model._meta.label_lower
+
+
+class CyclicDependencyError(Exception):
+    """
+    Raised by ``toposort`` when items depend on each other in a cycle.
+    ``components`` lists the items of each cycle.
+    """
+    def __init__(self, components):
+        self.components = components
+        super(CyclicDependencyError, self).__init__(
+            "Cyclic dependencies exist among %s items in %s cycles" % (
+                sum(len(component) for component in components), len(components)))
+
+
+def strongly_connected_components(nodes, successors):
+    """
+    Yield the strongly connected components of the graph of ``nodes`` as
+    lists, with an iterative Tarjan's algorithm, in O(V + E).
+
+    ``successors(node)`` returns the nodes ``node`` has edges to, which are
+    visited too. A component comes after the components it has edges to, so
+    with dependencies as edges they come in serialization order.
+    """
+    index = {}
+    lowlink = {}
+    stack = []
+    on_stack = set()
+    for root in nodes:
+        if root in index:
+            continue
+        index[root] = lowlink[root] = len(index)
+        stack.append(root)
+        on_stack.add(root)
+        work = [(root, iter(successors(root)))]
+        while work:
+            node, children = work[-1]
+            for child in children:
+                if child not in index:
+                    index[child] = lowlink[child] = len(index)
+                    stack.append(child)
+                    on_stack.add(child)
+                    work.append((child, iter(successors(child))))
+                    break
+                elif child in on_stack:
+                    lowlink[node] = min(lowlink[node], index[child])
+            else:
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    lowlink[parent] = min(lowlink[parent], lowlink[node])
+                if lowlink[node] == index[node]:
+                    component = []
+                    while True:
+                        member = stack.pop()
+                        on_stack.discard(member)
+                        component.append(member)
+                        if member == node:
+                            break
+                    yield component
+
+def toposort(data, allow_cycles=False, key=get_item_key):
+    """
+    Yield the items of ``data`` (``{item: set(items it depends on)}``) so
+    that every item comes after the items it depends on.
+
+    Kahn's algorithm, one layer at a time: a layer is every item whose
+    dependencies are all in the previous layers. Each layer is sorted by
+    ``key``, computed once per item. O(V + E) apart from the sorts.
+
+    The items left in or after cycles are grouped in strongly connected
+    components, which are yielded after the components they depend on, each
+    sorted by ``key``. Unless ``allow_cycles``, a ``CyclicDependencyError``
+    is raised instead.
+    """
+    # Items that are only dependencies come last, like missing keys.
+    items = list(data)
+    index = dict((item, i) for i, item in enumerate(items))
+    for deps in data.values():
+        for dep in deps:
+            if dep not in index:
+                index[dep] = len(items)
+                items.append(dep)
 
     # Ignore self dependencies.
-    for k, v in data.items():
-        v.discard(k)
-    # Find all items that don't depend on anything.
-    try:
-        extra_items_in_deps = reduce(set.union, data.values()) - set(data.keys())
-    except Exception:
-        extra_items_in_deps = []
-    # Add empty dependences where needed
-    data.update(dict([(item, set()) for item in extra_items_in_deps]))
-    while True:
-        ordered = set(item for item, dep in data.items() if not dep)
-        if not ordered:
-            break
+    pending = [0] * len(items)  # number of unresolved dependencies
+    depends = [[] for item in items]
+    dependents = [[] for item in items]
+    for item, deps in data.items():
+        i = index[item]
+        for dep in deps:
+            j = index[dep]
+            if j != i:
+                pending[i] += 1
+                depends[i].append(j)
+                dependents[j].append(i)
+
+    keys = [key(item) for item in items]
+    layer = [i for i, count in enumerate(pending) if not count]
+    done = 0
+    while layer:
         # Ordering is made explicit to make it easier to test.
-        for o in sorted(ordered, key=get_item_key):
-            yield o
-        data = dict([(item, (dep - ordered))
-                        for item, dep in data.items()
-                            if item not in ordered])
-    if allow_cycles:
-        for item, dep in data.items():
-            yield item
-    else:
-        if data:
-            print("Cyclic dependencies exist among these items:\n%s" % '\n'.join(repr(x) for x in data.items()))
-            print("\n-------------------------\n\n")
-            raise Exception()
+        layer.sort(key=keys.__getitem__)
+        next_layer = []
+        for i in layer:
+            yield items[i]
+            for j in dependents[i]:
+                pending[j] -= 1
+                if not pending[j]:
+                    next_layer.append(j)
+        done += len(layer)
+        layer = next_layer
+
+    if done == len(items):
+        return
+    remaining = [i for i, count in enumerate(pending) if count]
+    in_remaining = set(remaining)
+    components = list(strongly_connected_components(
+        remaining, lambda i: [j for j in depends[i] if j in in_remaining]))
+    if not allow_cycles:
+        raise CyclicDependencyError([
+            [items[i] for i in sorted(component, key=keys.__getitem__)]
+            for component in components if len(component) > 1])
+    for component in components:
+        for i in sorted(component, key=keys.__getitem__):
+            yield items[i]
 
 
 def topological_sort(graph_unsorted):